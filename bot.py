@@ -6,6 +6,9 @@ import discord
 import motor.motor_asyncio
 from discord.ext.commands import Bot, CommandNotFound
 
+from utils import checks
+from utils.gateway import GatewayFilter
+
 TOKEN = os.environ.get("TOKEN")
 MONGO_URI = os.environ.get("MONGO", "mongodb://localhost:27017")
 COGS = (
@@ -23,6 +26,7 @@ class Azuth(Bot):
         self.mclient = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
         self.mdb = self.mclient.azuth
         self.testing = 'test' in sys.argv
+        self.gateway = GatewayFilter()
 
 
 bot = Azuth(".")
@@ -34,6 +38,38 @@ async def on_ready():
     await bot.change_presence(game=discord.Game(name='on Discord & Dragons'))
 
 
+@bot.event
+async def on_socket_raw_receive(msg):
+    await bot.gateway.dispatch(msg)
+
+
+# a member's own role changes are part of the permission cache's key, but these change what their roles allow
+@bot.event
+async def on_server_update(before, after):
+    checks.invalidate(after.id)
+
+
+@bot.event
+async def on_server_role_create(role):
+    checks.invalidate(role.server.id)
+
+
+@bot.event
+async def on_server_role_delete(role):
+    checks.invalidate(role.server.id)
+
+
+@bot.event
+async def on_server_role_update(before, after):
+    checks.invalidate(after.server.id)
+
+
+@bot.event
+async def on_channel_update(before, after):
+    if not after.is_private:
+        checks.invalidate(after.server.id)
+
+
 @bot.event
 async def on_message(message):
     await bot.process_commands(message)
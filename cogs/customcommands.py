@@ -1,24 +1,45 @@
+import collections
 import random
+import re
 
 import discord
 from discord.ext import commands
 
 from utils import checks, colors
+from utils.cache import LRUCache
+from utils.ratelimit import TokenBucket
+from utils.triggers import TRIGGER_TYPES, TriggerMatcher, normalize_trigger, validate_regex
+
+TRIGGER_CACHE_SIZE = 1000
+COMMANDS_PER_PAGE = 10
+CHANNEL_RESPONSE_RATE = (5, 10)  # responses per seconds, per channel
+TRIGGER_RESPONSE_RATE = (2, 10)  # responses per seconds, per trigger per channel
+THROTTLE_CACHE_SIZE = 10000
+# a bucket left unused this long has refilled, so forgetting it can't let a channel respond sooner
+THROTTLE_CACHE_TTL = max(CHANNEL_RESPONSE_RATE[1], TRIGGER_RESPONSE_RATE[1])
 
 
 class CustomCommands:
     def __init__(self, bot):
         self.bot = bot
-        self._cache = {}
+        self._cache = LRUCache(TRIGGER_CACHE_SIZE)  # server id -> TriggerMatcher
+        self._channel_buckets = LRUCache(THROTTLE_CACHE_SIZE, ttl=THROTTLE_CACHE_TTL)  # channel id -> TokenBucket
+        # (channel id, name) -> TokenBucket
+        self._trigger_buckets = LRUCache(THROTTLE_CACHE_SIZE, ttl=THROTTLE_CACHE_TTL)
+        self.suppressed = collections.Counter()  # server id -> throttled responses
 
     async def on_message(self, message):
         if (not message.server) or message.author.bot:
             return
-        server_commands = await self.get_server_commands(message.server.id)
-        cmds = server_commands['commands']
+        triggers = await self.get_triggers(message.server.id)
+        if not triggers:
+            return
 
-        match = next((c for c in cmds if c['name'] == message.content.lower().strip()), None)
+        match = triggers.match(message.content)
         if match:
+            if not self.check_throttle(message.channel.id, match['name']):
+                self.suppressed[message.server.id] += 1
+                return
             try:
                 response = random.choice(match['responses'])
                 await self.bot.send_message(message.channel, response)
@@ -31,53 +52,120 @@ class CustomCommands:
         if ctx.invoked_subcommand is None:
             await self.bot.say("Incorrect usage. Use .help cc for help.")
 
+    def check_throttle(self, channel_id, name):
+        """Returns whether a channel may receive another custom command response, using a token if so."""
+        # buckets are set again on every use, so they only expire once they have been idle long enough to refill
+        channel_bucket = self._channel_buckets.get(channel_id) or TokenBucket(*CHANNEL_RESPONSE_RATE)
+        self._channel_buckets.set(channel_id, channel_bucket)
+        trigger_bucket = self._trigger_buckets.get((channel_id, name)) or TokenBucket(*TRIGGER_RESPONSE_RATE)
+        self._trigger_buckets.set((channel_id, name), trigger_bucket)
+
+        if not (channel_bucket.ready() and trigger_bucket.ready()):
+            return False
+        channel_bucket.consume()
+        trigger_bucket.consume()
+        return True
+
     @cc.command(pass_context=True, name="add")
     @checks.mod_or_permissions(manage_messages=True)
     async def cc_add(self, ctx, command, *, response):
         """Adds a response to a command."""
-        server_commands = await self.get_server_commands(ctx.message.server.id)
-        existing = next((c for c in server_commands['commands'] if c['name'] == command.lower().strip()), None)
+        await self.add_response(ctx.message.server.id, command, 'exact', response)
+
+    @cc.command(pass_context=True, name="addmatch")
+    @checks.mod_or_permissions(manage_messages=True)
+    async def cc_addmatch(self, ctx, type_, trigger, *, response):
+        """Adds a response to a trigger that is not a whole-message match.
+        Types: prefix (message starts with trigger), contains (trigger appears as a word), regex"""
+        type_ = type_.lower()
+        if type_ not in TRIGGER_TYPES:
+            return await self.bot.say(f"Trigger type must be one of {', '.join(TRIGGER_TYPES)}.")
+        if type_ == 'regex':
+            error = validate_regex(trigger)
+            if error is not None:
+                return await self.bot.say(error)
+        await self.add_response(ctx.message.server.id, trigger, type_, response)
+
+    async def add_response(self, server_id, command, type_, response):
+        server_commands = await self.get_server_commands(server_id)
+        name = normalize_trigger(command, type_)
+        existing = next((c for c in server_commands['commands']
+                         if c['name'] == name and c.get('type', 'exact') == type_), None)
         if not existing:
             server_commands['commands'].append({
-                "name": command.lower().strip(),
+                "name": name,
+                "type": type_,
                 "responses": [response]
             })
-            out = f"Created command `{command.lower().strip()}` and added response `{response}`."
+            out = f"Created command `{name}` and added response `{response}`."
         else:
             existing['responses'].append(response)
-            out = f"Added response `{response}` to command `{command.lower()}`."
+            out = f"Added response `{response}` to command `{name}`."
 
-        await self.set_server_commands(ctx.message.server.id, server_commands)
+        await self.set_server_commands(server_id, server_commands)
         await self.bot.say(out)
 
     @cc.command(pass_context=True, name="list")
     async def cc_list(self, ctx, page: int = 1):
         """Shows the list of custom commands."""
+        await self.send_command_page(ctx.message.server.id, page)
+
+    @cc.command(pass_context=True, name="search")
+    async def cc_search(self, ctx, prefix, page: int = 1):
+        """Shows the custom commands starting with a prefix."""
+        await self.send_command_page(ctx.message.server.id, page, prefix.lower().strip())
+
+    async def send_command_page(self, server_id, page, prefix=None):
         if page < 1:
             return await self.bot.say("Page must be at least 1.")
-        server_commands = await self.get_server_commands(ctx.message.server.id)
-        commands_ = sorted(server_commands['commands'], key=lambda c: c['name'])
-        start = (page - 1) * 10
-        end = page * 10
-        page_commands = commands_[start:end]
+        start = (page - 1) * COMMANDS_PER_PAGE
+        end = page * COMMANDS_PER_PAGE
+        page_commands = await self.get_command_page(server_id, start, prefix)
+        if not page_commands:
+            return await self.bot.say("No custom commands found.")
 
         embed = discord.Embed(colour=colors.BLURPLE)
         embed.title = f"Page {page} ({start+1}-{end})"
         for cmd in page_commands:
             responses = ' '.join(f"```\n{r}\n```" for r in cmd['responses'])
-            embed.add_field(name=cmd['name'], value=responses)
+            embed.add_field(name=display_name(cmd), value=responses)
 
         await self.bot.say(embed=embed)
 
+    @cc.command(pass_context=True, name="throttled")
+    @checks.mod_or_permissions(manage_messages=True)
+    async def cc_throttled(self, ctx):
+        """Shows how many custom command responses have been suppressed by flood protection since startup."""
+        await self.bot.say(f"Suppressed {self.suppressed[ctx.message.server.id]} custom command responses.")
+
     @cc.command(pass_context=True, name="remove")
     @checks.mod_or_permissions(manage_messages=True)
     async def cc_remove(self, ctx, cmd: str, *, response: str = None):
         """Removes a command or a certain response."""
-        server_commands = await self.get_server_commands(ctx.message.server.id)
+        await self.remove_response(ctx.message.server.id, cmd, None, response)
 
-        command = next((c for c in server_commands['commands'] if c['name'] == cmd.lower()), None)
-        if command is None:
+    @cc.command(pass_context=True, name="removematch")
+    @checks.mod_or_permissions(manage_messages=True)
+    async def cc_removematch(self, ctx, type_, trigger, *, response: str = None):
+        """Removes a trigger of a certain type, or a certain response from it."""
+        type_ = type_.lower()
+        if type_ not in TRIGGER_TYPES:
+            return await self.bot.say(f"Trigger type must be one of {', '.join(TRIGGER_TYPES)}.")
+        await self.remove_response(ctx.message.server.id, trigger, type_, response)
+
+    async def remove_response(self, server_id, cmd, type_, response):
+        """Removes a command or one of its responses. If no type is given, the name must only be used by one type."""
+        server_commands = await self.get_server_commands(server_id)
+
+        matches = [c for c in server_commands['commands'] if c['name'] in (cmd.strip(), cmd.lower().strip())
+                   and (type_ is None or c.get('type', 'exact') == type_)]
+        if not matches:
             return await self.bot.say("No matching command found.")
+        elif len(matches) > 1:
+            types = ', '.join(c.get('type', 'exact') for c in matches)
+            return await self.bot.say(f"There are multiple triggers named `{matches[0]['name']}` ({types}). "
+                                      f"Use `.cc removematch <type> <trigger>` to choose one.")
+        command = matches[0]
 
         if response is not None:
             response = next((r for r in command['responses'] if response.lower() == r.lower()), None)
@@ -91,12 +179,37 @@ class CustomCommands:
         else:
             server_commands['commands'].remove(command)
             out = f"Removed command {command['name']} and all responses."
-        await self.set_server_commands(ctx.message.server.id, server_commands)
+        await self.set_server_commands(server_id, server_commands)
         await self.bot.say(out)
 
+    async def get_triggers(self, server_id):
+        """Returns a server's compiled triggers, loading them from the database on a cache miss.
+        Servers without custom commands are cached as an empty matcher."""
+        triggers = self._cache.get(server_id)
+        if triggers is None:
+            server_commands = await self.bot.mdb.custcommands.find_one({"server": server_id}, ['commands'])
+            triggers = TriggerMatcher(server_commands['commands'] if server_commands else [])
+            self._cache.set(server_id, triggers)
+        return triggers
+
+    async def get_command_page(self, server_id, skip, prefix=None):
+        """Returns one page of a server's commands sorted by name, letting the database do the sort and slice."""
+        pipeline = [
+            {"$match": {"server": server_id}},
+            {"$project": {"_id": False, "commands": True}},
+            {"$unwind": "$commands"}
+        ]
+        if prefix:
+            pipeline.append({"$match": {"commands.name": {"$regex": f"^{re.escape(prefix)}"}}})
+        pipeline.extend([
+            {"$sort": {"commands.name": 1}},
+            {"$skip": skip},
+            {"$limit": COMMANDS_PER_PAGE},
+            {"$replaceRoot": {"newRoot": "$commands"}}
+        ])
+        return await self.bot.mdb.custcommands.aggregate(pipeline).to_list(None)
+
     async def get_server_commands(self, server_id):
-        if server_id in self._cache:
-            return self._cache[server_id]
         server_commands = await self.bot.mdb.custcommands.find_one({"server": server_id})
         if server_commands is None:
             server_commands = get_default_commands(server_id)
@@ -107,7 +220,7 @@ class CustomCommands:
             {"server": server_id},
             {"$set": cmds}, upsert=True
         )
-        self._cache[server_id] = cmds
+        self._cache.set(server_id, TriggerMatcher(cmds['commands']))
 
 
 def get_default_commands(server_id):
@@ -117,5 +230,12 @@ def get_default_commands(server_id):
     }
 
 
+def display_name(cmd):
+    type_ = cmd.get('type', 'exact')
+    if type_ == 'exact':
+        return cmd['name']
+    return f"{cmd['name']} ({type_})"
+
+
 def setup(bot):
     bot.add_cog(CustomCommands(bot))
@@ -1,37 +1,135 @@
 import asyncio
+import collections
+import datetime
 import random
+import sys
+import traceback
 
 import discord
 from discord.ext import commands
 
 from utils import checks
+from utils.cache import LRUCache
+from utils.functions import chunk_text
+from utils.ratelimit import SlidingWindow
+from utils.scheduler import Scheduler
+
+SETTINGS_CACHE_SIZE = 1000
+SETTINGS_CACHE_TTL = 60 * 60
+JOIN_FLOOD_THRESHOLD = 5  # joins per window before welcomes are batched
+JOIN_FLOOD_WINDOW = 10  # seconds
+JOIN_BATCH_DELAY = 5  # seconds to collect a batch for
+DEFAULT_MESSAGE = "Welcome to the server @!"
+DELETION_GRACE = 2  # seconds; deletions due this close together are bulk deleted together
+DELETION_RETRY_DELAY = 60  # seconds before retrying a deletion that failed unexpectedly
 
 
 class JoinAnnouncer:
     def __init__(self, bot):
         self.bot = bot
+        self._cache = LRUCache(SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL)  # server id -> settings, or False
+        self._join_rates = LRUCache(SETTINGS_CACHE_SIZE)  # server id -> SlidingWindow
+        self._batches = {}  # server id -> members waiting for a batched welcome
+        self.deletions = Scheduler(bot, self.delete_messages, grace=DELETION_GRACE)
+        bot.loop.create_task(self.load_deletions())
+        bot.loop.create_task(self.deletions.run())
 
     async def on_member_join(self, member):
         await self.bot.wait_until_ready()
-        server_settings = await self.bot.mdb.join.find_one({"server": member.server.id})
-        if server_settings is None or not server_settings['enabled']:
+        server_settings = await self.get_announce_settings(member.server.id)
+        if not server_settings:
+            return
+        server_id = member.server.id
+
+        join_rate = self._join_rates.get(server_id)
+        if join_rate is None:
+            join_rate = SlidingWindow(JOIN_FLOOD_WINDOW)
+            self._join_rates.set(server_id, join_rate)
+        recent_joins = join_rate.hit()
+        if server_id in self._batches:
+            self._batches[server_id].append(member)
+            return
+        elif recent_joins > JOIN_FLOOD_THRESHOLD:
+            self._batches[server_id] = [member]
+            self.bot.loop.create_task(self.flush_batch(member.server))
+            return
+
+        await self.send_welcome(member.server, server_settings, [member])
+
+    async def flush_batch(self, server):
+        """Welcomes everyone who joined during a join flood in as few messages as possible."""
+        await asyncio.sleep(JOIN_BATCH_DELAY)
+        members = self._batches.pop(server.id, [])
+        server_settings = await self.get_announce_settings(server.id)
+        if members and server_settings:
+            await self.send_welcome(server, server_settings, members)
+
+    async def send_welcome(self, server, server_settings, members):
+        destination = server.get_channel(server_settings['destination'])
+        if not destination:
             return
-        destination = member.server.get_channel(server_settings['destination'])
         messages = server_settings['messages']
         deleteafter = server_settings['deleteafter']
-        if messages:
-            message = random.choice(messages).replace('@', member.mention)
-        else:
-            message = "Welcome to the server " + member.mention + "!"
+        template = random.choice(messages) if messages else DEFAULT_MESSAGE
 
-        if destination:
-            msg = await self.bot.send_message(destination, message)
+        # each chunk of mentions replaces every @ in the template, so leave room for all of them
+        mention_limit = (2000 - len(template)) // max(template.count('@'), 1)
+        for mentions in chunk_text((m.mention for m in members), sep=', ', limit=mention_limit):
+            msg = await self.bot.send_message(destination, template.replace('@', mentions))
             if deleteafter:
-                await asyncio.sleep(deleteafter)
-                try:
-                    await self.bot.delete_message(msg)
-                except:
-                    pass
+                await self.schedule_deletion(msg, datetime.datetime.now() + datetime.timedelta(seconds=deleteafter))
+
+    async def load_deletions(self):
+        """Reschedules join message deletions that were pending when the bot last stopped."""
+        await self.bot.mdb.join_deletions.create_index("time")
+        await self.bot.mdb.join_deletions.create_index("message")
+        async for deletion in self.bot.mdb.join_deletions.find():
+            self.deletions.schedule(deletion['time'],
+                                    (deletion['server'], deletion['channel'], deletion['message']))
+
+    async def schedule_deletion(self, message, time):
+        await self.bot.mdb.join_deletions.insert_one(
+            {"server": message.server.id, "channel": message.channel.id, "message": message.id, "time": time})
+        self.deletions.schedule(time, (message.server.id, message.channel.id, message.id))
+
+    async def delete_messages(self, deletions):
+        """Deletes due join messages, using one bulk delete per channel where possible."""
+        by_channel = collections.defaultdict(list)
+        for server_id, channel_id, message_id in deletions:
+            by_channel[server_id, channel_id].append(message_id)
+
+        done = []
+        for (server_id, channel_id), message_ids in by_channel.items():
+            for i in range(0, len(message_ids), 100):  # bulk delete takes at most 100 messages
+                batch = message_ids[i:i + 100]
+                if len(batch) > 1:
+                    try:
+                        await self.bot.http.delete_messages(channel_id, batch, server_id)
+                        done.extend(batch)
+                        continue
+                    except discord.HTTPException:  # e.g. one is already gone; find out which one by one
+                        pass
+                for message_id in batch:
+                    if await self.delete_message(server_id, channel_id, message_id):
+                        done.append(message_id)
+                    else:  # keep it saved, so it is also retried after a restart
+                        self.deletions.schedule(
+                            datetime.datetime.now() + datetime.timedelta(seconds=DELETION_RETRY_DELAY),
+                            (server_id, channel_id, message_id))
+
+        if done:
+            await self.bot.mdb.join_deletions.delete_many({"message": {"$in": done}})
+
+    async def delete_message(self, server_id, channel_id, message_id):
+        """Deletes one join message, returning False if it should be tried again."""
+        try:
+            await self.bot.http.delete_message(channel_id, message_id, server_id)
+        except (discord.NotFound, discord.Forbidden):  # already deleted, or never will be
+            pass
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            return False
+        return True
 
     @commands.group(pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_server=True)
@@ -118,6 +216,16 @@ class JoinAnnouncer:
 
         await self.bot.say("Removed join message: `{}`".format(msg))
 
+    async def get_announce_settings(self, server_id):
+        """Returns a server's join settings if announcements are enabled, or False. Results are cached."""
+        server_settings = self._cache.get(server_id)
+        if server_settings is None:
+            server_settings = await self.bot.mdb.join.find_one({"server": server_id})
+            if server_settings is None or not server_settings['enabled']:
+                server_settings = False
+            self._cache.set(server_id, server_settings)
+        return server_settings
+
     async def get_server_settings(self, server_id, projection=None):
         server_settings = await self.bot.mdb.join.find_one({"server": server_id}, projection)
         if server_settings is None:
@@ -129,6 +237,12 @@ class JoinAnnouncer:
             {"server": server_id},
             {"$set": settings}, upsert=True
         )
+        cached = self._cache.get(server_id)
+        if cached:
+            cached.update(settings)
+            self._cache.set(server_id, cached if cached['enabled'] else False)
+        else:  # announcements were disabled or not cached, reload on next join
+            self._cache.pop(server_id)
 
 
 def get_default_settings(server):
@@ -1,24 +1,68 @@
 import asyncio
+import collections
+import contextlib
+import csv
 import datetime
+import gzip
+import io
+import json
 import re
+import sys
+import traceback
 
 import discord
-from discord import Forbidden
+from discord import Forbidden, NotFound
 from discord.ext import commands
 from discord.http import Route
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 
 from utils import checks
+from utils.cache import LRUCache
+from utils.functions import chunk_text
+from utils.logsink import EmbedSink
+from utils.permissions import bulk_edit_permissions, diff_overwrites
+from utils.ratelimit import SlidingWindow
+from utils.scheduler import Scheduler
 
 MUTED_ROLE = "316134780976758786"
 MESSAGE_LOG_CHANNEL_ID = "468251139691773972"
 MOD_LOG_CHANNEL_ID = "283404995951460363"
+CASE_PROJECTION = {"_id": False, "server": False}
+LEGACY_PROJECTION = {"cases": False, "warnings": False, "pending_actions": False}
+RAID_JOIN_THRESHOLD = 10  # default joins per window that trigger automatic raid detection
+RAID_JOIN_WINDOW = 10  # default seconds
+AUTORAID_ACTIONS = ('off', 'alert', 'kick', 'ban')
+RAID_WORKERS = 4  # concurrent kicks/bans per server; the HTTP client queues them per rate limit bucket
+RAID_LOG_INTERVAL = 5  # seconds to collect raidmode cases for before logging them together
+RAID_LOG_RETRIES = 3  # times to retry recording a batch of raidmode cases
+JOIN_RATE_CACHE_SIZE = 1000  # servers whose recent joins are counted for raid detection
+CASE_INDEX_SIZE = 100  # servers whose case history is kept in memory
+PURGE_SUPPRESS_SIZE = 10000
+PURGE_SUPPRESS_TTL = 60  # seconds to wait for a purged message's delete event
+EXPECTED_EVENT_SIZE = 10000
+EXPECTED_EVENT_TTL = 30  # seconds to wait for the event of an action the bot took
+PENDING_RETRY_DELAY = 5 * 60  # seconds before retrying an unban/unmute that failed unexpectedly
+EXPORT_FORMATS = ('jsonl', 'csv')
+EXPORT_FIELDS = ('num', 'type', 'user', 'username', 'reason', 'mod', 'log_msg', 'timestamp')
+EXPORT_PART_SIZE = 7 * 1024 * 1024  # compressed bytes per file, leaving room under the 8MB upload limit
 
 
 class Moderation:
     def __init__(self, bot):
         self.bot = bot
-        self.no_ban_logs = set()
-        bot.loop.create_task(self.check_pending())
+        self.expected = ExpectedEvents()  # ban/unban/mute/unmute events caused by the bot itself
+        self._join_states = {}  # server id -> JoinState
+        self._join_rates = LRUCache(JOIN_RATE_CACHE_SIZE)  # server id -> SlidingWindow
+        self._raid_responders = {}  # server id -> RaidResponder
+        self._log_sinks = {}  # channel id -> EmbedSink
+        self._case_indexes = LRUCache(CASE_INDEX_SIZE)  # server id -> CaseIndex
+        self._case_locks = collections.defaultdict(asyncio.Lock)  # server id -> lock on loading/adding to its index
+        self._purged = LRUCache(PURGE_SUPPRESS_SIZE, ttl=PURGE_SUPPRESS_TTL)  # message ids deleted by a purge
+        self.pending = Scheduler(bot, self.run_pending_actions)
+        bot.loop.create_task(self.load_pending_actions())
+        bot.loop.create_task(self.pending.run())
+        bot.loop.create_task(self.load_privileged_roles())
 
     @commands.command(hidden=True, pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -37,7 +81,9 @@ class Moderation:
     @checks.mod_or_permissions(manage_messages=True)
     async def purge_bot(self, ctx, limit: int = 50):
         """Purges bot messages from the last [limit] messages (default 50)."""
-        deleted = await self.bot.purge_from(ctx.message.channel, check=lambda m: m.author.bot, limit=limit)
+        deleted = await self.bot.purge_from(ctx.message.channel, check=self.purge_check(lambda m: m.author.bot),
+                                            limit=limit)
+        await self.post_purge_transcript(ctx, deleted)
         await self.bot.say("Cleaned {} messages.".format(len(deleted)))
 
     @commands.command(pass_context=True)
@@ -46,9 +92,37 @@ class Moderation:
         """Purges messages from the channel.
         Requires: Bot Mod or Manage Messages"""
         try:
-            await self.bot.purge_from(ctx.message.channel, limit=(num + 1))
+            deleted = await self.bot.purge_from(ctx.message.channel, check=self.purge_check(), limit=(num + 1))
         except Exception as e:
-            await self.bot.say('Failed to purge: ' + str(e))
+            return await self.bot.say('Failed to purge: ' + str(e))
+        await self.post_purge_transcript(ctx, deleted)
+
+    def purge_check(self, check=None):
+        """Wraps a purge check so that the delete events of purged messages are not logged individually."""
+
+        def predicate(message):
+            if check is not None and not check(message):
+                return False
+            self._purged.set(message.id, True)
+            return True
+
+        return predicate
+
+    async def post_purge_transcript(self, ctx, messages):
+        """Uploads one transcript of purged messages to the message log."""
+        msg_log = discord.utils.get(ctx.message.server.channels, id=MESSAGE_LOG_CHANNEL_ID)
+        if not (msg_log and messages):
+            return
+        transcript = io.BytesIO()
+        for message in reversed(messages):  # oldest first
+            line = json.dumps({"id": message.id, "author": str(message.author), "author_id": message.author.id,
+                               "timestamp": message.timestamp.isoformat(), "content": message.content,
+                               "attachments": [a['url'] for a in message.attachments]})
+            transcript.write(line.encode() + b'\n')
+        transcript.seek(0)
+        await self.bot.send_file(msg_log, transcript, filename=f"purge-{ctx.message.channel.id}.jsonl",
+                                 content=f"{ctx.message.author} purged {len(messages)} messages "
+                                         f"in {ctx.message.channel}.")
 
     @commands.command(hidden=True, pass_context=True, no_pm=True)
     @checks.mod_or_permissions(manage_roles=True)
@@ -58,14 +132,18 @@ class Moderation:
         source_role = role
         source_overrides = source_chan.overwrites_for(source_role)
         skipped = []
+        edits = []
         for chan in ctx.message.server.channels:
             if chan.type != source_chan.type:
                 continue
             chan_overrides = chan.overwrites_for(source_role)
-            if chan_overrides.is_empty() or overwrite:
-                await self.bot.edit_channel_permissions(chan, source_role, source_overrides)
+            if chan_overrides.pair() == source_overrides.pair():
+                continue
+            elif chan_overrides.is_empty() or overwrite:
+                edits.append((chan, source_role, source_overrides))
             else:
                 skipped.append(chan.name)
+        await self.bulk_overwrite(edits, "Copying permissions to")
 
         if skipped:
             skipped_str = ', '.join(skipped)
@@ -95,86 +173,220 @@ class Moderation:
             server_settings['raidmode'] = method
             out = f"Raid mode enabled. Method: {method}"
 
-        await self.set_server_settings(ctx.message.server.id, server_settings)
+        await self.set_server_settings(ctx.message.server.id, {"raidmode": server_settings['raidmode'],
+                                                               "locked_channels": server_settings['locked_channels']})
+        (await self.get_join_state(ctx.message.server.id)).raidmode = server_settings['raidmode']
         await self.bot.say(out)
 
+    @commands.command(hidden=True, pass_context=True, no_pm=True)
+    @checks.mod_or_permissions(ban_members=True)
+    async def autoraid(self, ctx, action=None, threshold: int = RAID_JOIN_THRESHOLD, window: int = RAID_JOIN_WINDOW):
+        """Sets what happens when at least threshold members join within window seconds.
+        Actions: off, alert (post in the mod log), kick or ban (also enable that raidmode). Off by default."""
+        join_state = await self.get_join_state(ctx.message.server.id)
+        if action is None:
+            if join_state.autoraid is None:
+                return await self.bot.say("Raid detection is off.")
+            return await self.bot.say(f"Raid detection: {join_state.autoraid['action']} at "
+                                      f"{join_state.autoraid['threshold']} joins in "
+                                      f"{join_state.autoraid['window']} seconds.")
+        action = action.lower()
+        if action not in AUTORAID_ACTIONS:
+            return await self.bot.say(f"Action must be one of {', '.join(AUTORAID_ACTIONS)}.")
+        if threshold < 2 or window < 1:
+            return await self.bot.say("Threshold must be at least 2 and window at least 1 second.")
+
+        if action == 'off':
+            join_state.autoraid = None
+        else:
+            join_state.autoraid = {"action": action, "threshold": threshold, "window": window}
+        self._join_rates.pop(ctx.message.server.id, None)
+        await self.set_server_settings(ctx.message.server.id, {"autoraid": join_state.autoraid})
+        await self.bot.say(':ok_hand:')
+
+    @commands.group(hidden=True, pass_context=True, no_pm=True)
+    @checks.mod_or_permissions(ban_members=True)
+    async def lockdown(self, ctx):
+        """Commands to finish or undo a lockdown that was interrupted."""
+        if ctx.invoked_subcommand is None:
+            await self.bot.say("Incorrect usage. Use .help lockdown for help.")
+
+    @lockdown.command(hidden=True, pass_context=True, name='resume')
+    @checks.mod_or_permissions(ban_members=True)
+    async def lockdown_resume(self, ctx):
+        """Locks any channels a lockdown missed and turns on lockdown raidmode."""
+        await self.start_lockdown(ctx, await self.get_server_settings(ctx.message.server.id))
+        await self.set_server_settings(ctx.message.server.id, {"raidmode": 'lockdown'})
+        (await self.get_join_state(ctx.message.server.id)).raidmode = 'lockdown'
+
+    @lockdown.command(hidden=True, pass_context=True, name='rollback')
+    @checks.mod_or_permissions(ban_members=True)
+    async def lockdown_rollback(self, ctx):
+        """Unlocks every channel a lockdown locked and turns off raidmode."""
+        server_settings = await self.get_server_settings(ctx.message.server.id)
+        await self.end_lockdown(ctx, server_settings)
+        await self.set_server_settings(ctx.message.server.id, {"raidmode": None,
+                                                               "locked_channels": server_settings['locked_channels']})
+        (await self.get_join_state(ctx.message.server.id)).raidmode = None
+
+    @commands.group(hidden=True, pass_context=True, no_pm=True, invoke_without_command=True)
+    @checks.serverowner_or_permissions(administrator=True)
+    async def modroles(self, ctx):
+        """Shows the roles that can use mod and admin commands without their permissions."""
+        server = ctx.message.server
+        mod_ids, admin_ids = checks.get_privileged_role_ids(server)
+        mod_roles = ', '.join(r.name for r in server.roles if r.id in mod_ids) or "None"
+        admin_roles = ', '.join(r.name for r in server.roles if r.id in admin_ids) or "None"
+        await self.bot.say(f"**Mod roles**: {mod_roles}\n**Admin roles**: {admin_roles}\n"
+                           f"Admin roles can also use mod commands.")
+
+    @modroles.command(hidden=True, pass_context=True, name='mod')
+    @checks.serverowner_or_permissions(administrator=True)
+    async def modroles_mod(self, ctx, *roles):
+        """Sets the mod roles, by name, ID, or mention."""
+        _, admin_roles = checks.get_privileged_roles(ctx.message.server.id)
+        await self.set_privileged_roles(ctx.message.server.id, [normalize_role(r) for r in roles], admin_roles)
+        await self.bot.say(':ok_hand:')
+
+    @modroles.command(hidden=True, pass_context=True, name='admin')
+    @checks.serverowner_or_permissions(administrator=True)
+    async def modroles_admin(self, ctx, *roles):
+        """Sets the admin roles, by name, ID, or mention."""
+        mod_roles, _ = checks.get_privileged_roles(ctx.message.server.id)
+        await self.set_privileged_roles(ctx.message.server.id, mod_roles, [normalize_role(r) for r in roles])
+        await self.bot.say(':ok_hand:')
+
+    @modroles.command(hidden=True, pass_context=True, name='reset')
+    @checks.serverowner_or_permissions(administrator=True)
+    async def modroles_reset(self, ctx):
+        """Resets the mod and admin roles to roles named Moderator and Admin."""
+        await self.set_privileged_roles(ctx.message.server.id, None, None)
+        await self.bot.say(':ok_hand:')
+
     @commands.group(hidden=True, pass_context=True, invoke_without_command=True, aliases=['warning'])
     @checks.mod_or_permissions(manage_messages=True)
     async def warn(self, ctx, target: discord.Member, *, reason="Unknown reason"):
         """Warns a member (for moderator reference)."""
-        server_settings = await self.get_server_settings(ctx.message.server.id)
-        previous_warnings = [w for w in server_settings['warnings'] if w['user'] == target.id]
-        previous_actions = [a for a in server_settings['cases'] if a['user'] == target.id and a.get('type') != 'warn']
+        previous_cases = await self.get_user_cases(ctx.message.server.id, target.id)
         out = "Warning logged. Further infractions may lead to a temporary to permanent ban.\n"
-        if previous_warnings or previous_actions:
-            out += f"{target.mention} has {len(previous_warnings) + len(previous_actions)} previous action(s)!\n"
-            for warn in previous_warnings:
-                try:
-                    case = Case.from_id(server_settings, warn['case'])
-                except:
-                    out += f"[warn] Case {warn['case']} (not found)\n"
-                    continue
-                out += f"[warn] Case {warn['case']} - {case.reason}\n"
-            for action in previous_actions:
-                case = Case.from_dict(action)
-                out += f"[{case.type}] Case {case.num} - {case.reason}\n"
+        if previous_cases:
+            out += f"{target.mention} has {len(previous_cases)} previous action(s)!\n"
+            out += format_case_history(previous_cases)
 
-        case = Case.new(num=server_settings['casenum'], type_='warn', user=target.id, username=str(target),
+        case = Case.new(type_='warn', user=target.id, username=str(target),
                         reason=reason, mod=str(ctx.message.author))
-        server_settings['warnings'].append({'user': target.id, 'case': case.num})
-        await self.post_action(ctx.message.server, server_settings, case, msg=out)
+        await self.post_action(ctx.message.server, case, no_msg=True)
+        await self.say_paginated(out)
 
     @warn.command(hidden=True, pass_context=True, invoke_without_command=True, name='list')
     @checks.mod_or_permissions(manage_messages=True)
     async def warn_list(self, ctx, target: discord.Member):
         """Finds a list of a user's previous warnings."""
-        server_settings = await self.get_server_settings(ctx.message.server.id)
-        previous_warnings = [w for w in server_settings['warnings'] if w['user'] == target.id]
-        previous_actions = [a for a in server_settings['cases'] if a['user'] == target.id and a.get('type') != 'warn']
-        out = f"{target.mention} has {len(previous_warnings)} previous action(s).\n"
-        for warn in previous_warnings:
-            try:
-                case = Case.from_id(server_settings, warn['case'])
-            except:
-                out += f"[warn] Case {warn['case']} (not found)\n"
-                continue
-            out += f"[warn] Case {warn['case']} - {case.reason}\n"
-        for action in previous_actions:
-            case = Case.from_dict(action)
-            out += f"[{case.type}] Case {case.num} - {case.reason}\n"
-        await self.bot.say(out)
+        previous_cases = await self.get_user_cases(ctx.message.server.id, target.id)
+        out = f"{target.mention} has {len(previous_cases)} previous action(s).\n"
+        out += format_case_history(previous_cases)
+        await self.say_paginated(out)
+
+    @commands.group(hidden=True, pass_context=True, no_pm=True)
+    @checks.admin_or_permissions(administrator=True)
+    async def cases(self, ctx):
+        """Commands to work with a server's full case history."""
+        if ctx.invoked_subcommand is None:
+            await self.bot.say("Incorrect usage. Use .help cases for help.")
+
+    @cases.command(hidden=True, pass_context=True, name='export')
+    @checks.admin_or_permissions(administrator=True)
+    async def cases_export(self, ctx, since='all', type_='all', user='all', fmt='jsonl'):
+        """Uploads the server's cases as gzipped JSONL or CSV files.
+        Since is a duration like `30d`, type is a case type like `ban`, and user is a user ID or mention.
+        Pass `all` to skip any filter. The format is `jsonl` or `csv`."""
+        if fmt not in EXPORT_FORMATS:
+            return await self.bot.say(f"Format must be one of {', '.join(EXPORT_FORMATS)}.")
+        query = {"server": ctx.message.server.id}
+        if since != 'all':
+            duration = parse_duration(since)
+            if not duration:
+                return await self.bot.say("Invalid duration.")
+            query['timestamp'] = {"$gte": datetime.datetime.utcnow() - duration}
+        if type_ != 'all':
+            query['type'] = type_.lower()
+        if user != 'all':
+            query['user'] = user.strip('<@!>')
+
+        # cases are written to the current part as they arrive, so only one part is ever held in memory
+        export = CaseExport(fmt)
+        total = parts = 0
+        async for raw in self.bot.mdb.mod_cases.find(query, {"server": False}).sort("num"):
+            export.write(raw)
+            total += 1
+            if export.full:
+                parts += 1
+                await self.upload_export(ctx, export, parts)
+                export = CaseExport(fmt)
+        if export.count or not parts:
+            parts += 1
+            await self.upload_export(ctx, export, parts)
+        await self.bot.say(f"Exported {total} cases in {parts} file(s).")
+
+    @commands.command(hidden=True, pass_context=True, no_pm=True)
+    @checks.mod_or_permissions(manage_messages=True)
+    async def modstats(self, ctx, period='7d'):
+        """Shows how many actions were taken by each moderator, of each type, and on each day over a period."""
+        duration = parse_duration(period)
+        if not duration:
+            return await self.bot.say("Invalid duration.")
+        start = get_stats_day(datetime.datetime.utcnow() - duration)
+
+        by_mod = collections.Counter()
+        by_type = collections.Counter()
+        by_day = collections.Counter()
+        async for counter in self.bot.mdb.mod_stats.find({"server": ctx.message.server.id, "day": {"$gte": start}}):
+            by_mod[counter['mod'] or "Unknown"] += counter['count']
+            by_type[counter['type']] += counter['count']
+            by_day[counter['day']] += counter['count']
+        total = sum(by_day.values())
+        if not total:
+            return await self.bot.say(f"No actions since {start:%Y-%m-%d}.")
+
+        out = f"**{total} actions since {start:%Y-%m-%d}**\n\n**By moderator**\n"
+        out += '\n'.join(f"{mod}: {count}" for mod, count in (+by_mod).most_common())
+        out += "\n\n**By type**\n"
+        out += '\n'.join(f"{type_.title()}: {count}" for type_, count in (+by_type).most_common())
+        out += "\n\n**By day**\n"
+        out += '\n'.join(f"{day:%Y-%m-%d}: {count}" for day, count in sorted((+by_day).items()))
+        await self.say_paginated(out)
+
+    async def upload_export(self, ctx, export, part):
+        filename = f"cases-{ctx.message.server.id}-{part}.{export.fmt}.gz"
+        await self.bot.send_file(ctx.message.channel, export.finish(), filename=filename,
+                                 content=f"Part {part}: {export.count} cases.")
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(manage_roles=True)
     async def mute(self, ctx, target: discord.Member, *, reason="Unknown reason"):
         """Toggles mute on a member."""
         role = discord.utils.get(ctx.message.server.roles, id=MUTED_ROLE)
-        server_settings = await self.get_server_settings(ctx.message.server.id)
 
         if role in target.roles:
             try:
-                self.no_ban_logs.add(ctx.message.server.id)
-                await self.bot.remove_roles(target, role)
+                with self.expected.expecting(ctx.message.server.id, target.id, 'unmute'):
+                    await self.bot.remove_roles(target, role)
             except Forbidden:
                 return await self.bot.say("Error: The bot does not have `manage_roles` permission.")
-            finally:
-                self.no_ban_logs.remove(ctx.message.server.id)
-            case = Case.new(num=server_settings['casenum'], type_='unmute', user=target.id, username=str(target),
+            case = Case.new(type_='unmute', user=target.id, username=str(target),
                             reason=reason, mod=str(ctx.message.author))
-            on_unmute(server_settings, target)
+            await self.set_muted(ctx.message.server.id, target.id, False)
         else:
             try:
-                self.no_ban_logs.add(ctx.message.server.id)
-                await self.bot.add_roles(target, role)
+                with self.expected.expecting(ctx.message.server.id, target.id, 'mute'):
+                    await self.bot.add_roles(target, role)
             except Forbidden:
                 return await self.bot.say("Error: The bot does not have `manage_roles` permission.")
-            finally:
-                self.no_ban_logs.remove(ctx.message.server.id)
-            case = Case.new(num=server_settings['casenum'], type_='mute', user=target.id, username=str(target),
+            case = Case.new(type_='mute', user=target.id, username=str(target),
                             reason=reason, mod=str(ctx.message.author))
-            on_mute(server_settings, target)
+            await self.set_muted(ctx.message.server.id, target.id, True)
 
-        await self.post_action(ctx.message.server, server_settings, case)
+        await self.post_action(ctx.message.server, case)
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(manage_roles=True)
@@ -182,7 +394,6 @@ class Moderation:
         """Temporarily mutes a member.
         Duration must be in format X[m/h/d/w/mo/y] (e.g. `15d38m`)."""
         role = discord.utils.get(ctx.message.server.roles, id=MUTED_ROLE)
-        server_settings = await self.get_server_settings(ctx.message.server.id)
         duration = parse_duration(duration)
         end = datetime.datetime.now() + duration
 
@@ -190,20 +401,16 @@ class Moderation:
             return await self.bot.say("Member is already muted.")
 
         try:
-            self.no_ban_logs.add(ctx.message.server.id)
-            await self.bot.add_roles(target, role)
-            await asyncio.sleep(0.5)
+            with self.expected.expecting(ctx.message.server.id, target.id, 'mute'):
+                await self.bot.add_roles(target, role)
         except Forbidden:
             return await self.bot.say("Error: The bot does not have `manage_roles` permission.")
-        finally:
-            self.no_ban_logs.remove(ctx.message.server.id)
-        case = Case.new(num=server_settings['casenum'], type_='tempmute', user=target.id, username=str(target),
+        case = Case.new(type_='tempmute', user=target.id, username=str(target),
                         reason=f"{reason} [{str(duration)}]", mod=str(ctx.message.author))
-        on_mute(server_settings, target)
-        server_settings['pending_actions'].append(
-            {"user": target.id, "action": "unmute", "original_case": case.num, "time": end})
-
-        await self.post_action(ctx.message.server, server_settings, case)
+        await self.set_muted(ctx.message.server.id, target.id, True)
+        await self.post_action(ctx.message.server, case)
+        await self.add_pending_action({"server": ctx.message.server.id, "user": target.id, "action": "unmute",
+                                       "original_case": case.num, "time": end})
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(kick_members=True)
@@ -214,29 +421,23 @@ class Moderation:
         except Forbidden:
             return await self.bot.say('Error: The bot does not have `kick_members` permission.')
 
-        server_settings = await self.get_server_settings(ctx.message.server.id)
-
-        case = Case.new(num=server_settings['casenum'], type_='kick', user=user.id, username=str(user), reason=reason,
+        case = Case.new(type_='kick', user=user.id, username=str(user), reason=reason,
                         mod=str(ctx.message.author))
-        await self.post_action(ctx.message.server, server_settings, case)
+        await self.post_action(ctx.message.server, case)
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(ban_members=True)
     async def ban(self, ctx, user: discord.Member, *, reason='Unknown reason'):
         """Bans a member and logs it to #mod-log."""
         try:
-            self.no_ban_logs.add(ctx.message.server.id)
-            await self.bot.ban(user)
+            with self.expected.expecting(ctx.message.server.id, user.id, 'ban'):
+                await self.bot.ban(user)
         except Forbidden:
             return await self.bot.say('Error: The bot does not have `ban_members` permission.')
-        finally:
-            self.no_ban_logs.remove(ctx.message.server.id)
-
-        server_settings = await self.get_server_settings(ctx.message.server.id)
 
-        case = Case.new(num=server_settings['casenum'], type_='ban', user=user.id, username=str(user), reason=reason,
+        case = Case.new(type_='ban', user=user.id, username=str(user), reason=reason,
                         mod=str(ctx.message.author))
-        await self.post_action(ctx.message.server, server_settings, case)
+        await self.post_action(ctx.message.server, case)
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(ban_members=True)
@@ -244,24 +445,19 @@ class Moderation:
         """Tempbans a member and logs it to #mod-log.
         Duration must be in format X[m/h/d/w/mo/y] (e.g. `15d38m`)."""
         try:
-            self.no_ban_logs.add(ctx.message.server.id)
-            await self.bot.ban(user)
-            await asyncio.sleep(0.5)
+            with self.expected.expecting(ctx.message.server.id, user.id, 'ban'):
+                await self.bot.ban(user)
         except Forbidden:
             return await self.bot.say('Error: The bot does not have `ban_members` permission.')
-        finally:
-            self.no_ban_logs.remove(ctx.message.server.id)
 
-        server_settings = await self.get_server_settings(ctx.message.server.id)
         duration = parse_duration(duration)
         end = datetime.datetime.now() + duration
 
-        case = Case.new(num=server_settings['casenum'], type_='tempban', user=user.id, username=str(user),
+        case = Case.new(type_='tempban', user=user.id, username=str(user),
                         reason=f"{reason} [{str(duration)}]", mod=str(ctx.message.author))
-        server_settings['pending_actions'].append(
-            {"user": user.id, "action": "unban", "original_case": case.num, "time": end})
-
-        await self.post_action(ctx.message.server, server_settings, case)
+        await self.post_action(ctx.message.server, case)
+        await self.add_pending_action({"server": ctx.message.server.id, "user": user.id, "action": "unban",
+                                       "original_case": case.num, "time": end})
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(ban_members=True)
@@ -273,185 +469,291 @@ class Moderation:
 
         user_obj = await self.bot.get_user_info(user)
 
-        server_settings = await self.get_server_settings(ctx.message.server.id)
-        server_settings['forcebanned'].append(user)
+        await self.set_forcebanned(ctx.message.server.id, user, True)
 
-        case = Case.new(num=server_settings['casenum'], type_='forceban', user=user, username=str(user_obj),
+        case = Case.new(type_='forceban', user=user, username=str(user_obj),
                         reason=reason, mod=str(ctx.message.author))
-        await self.post_action(ctx.message.server, server_settings, case)
+        await self.post_action(ctx.message.server, case)
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(ban_members=True)
     async def softban(self, ctx, user: discord.Member, *, reason='Unknown reason'):
         """Softbans a member and logs it to #mod-log."""
         try:
-            self.no_ban_logs.add(ctx.message.server.id)
-            await self.bot.ban(user)
-            await self.bot.unban(ctx.message.server, user)
-            await asyncio.sleep(0.5)
+            with self.expected.expecting(ctx.message.server.id, user.id, 'ban'):
+                await self.bot.ban(user)
+            with self.expected.expecting(ctx.message.server.id, user.id, 'unban'):
+                await self.bot.unban(ctx.message.server, user)
         except Forbidden:
             return await self.bot.say('Error: The bot does not have `ban_members` permission.')
-        finally:
-            self.no_ban_logs.remove(ctx.message.server.id)
-
-        server_settings = await self.get_server_settings(ctx.message.server.id)
 
-        case = Case.new(num=server_settings['casenum'], type_='softban', user=user.id, username=str(user),
+        case = Case.new(type_='softban', user=user.id, username=str(user),
                         reason=reason, mod=str(ctx.message.author))
-        await self.post_action(ctx.message.server, server_settings, case)
+        await self.post_action(ctx.message.server, case)
 
     @commands.command(hidden=True, pass_context=True)
     @checks.mod_or_permissions(kick_members=True)
     async def reason(self, ctx, case_num: int, *, reason):
         """Sets the reason for a post in mod-log."""
-        server_settings = await self.get_server_settings(ctx.message.server.id)
-        cases = server_settings['cases']
-        case = next((c for c in cases if c['num'] == case_num), None)
+        case_index = await self.get_case_index(ctx.message.server.id)
+        case = case_index.by_num.get(case_num)
         if case is None:
             return await self.bot.say(f"Case {case_num} not found.")
 
-        case = Case.from_dict(case)
-        case.reason = reason
-        case.mod = str(ctx.message.author)
+        # the cached case is only changed once everything else has been
+        updated = Case.from_dict(case.to_dict())
+        updated.reason = reason
+        updated.mod = str(ctx.message.author)
 
         mod_log = discord.utils.get(ctx.message.server.channels, id=MOD_LOG_CHANNEL_ID)
         if mod_log is not None and case.log_msg:
-            log_message = await self.bot.get_message(mod_log, case.log_msg)
-            await self.bot.edit_message(log_message, str(case))
-
-        await self.set_server_settings(ctx.message.server.id, server_settings)
+            try:
+                log_message = await self.bot.get_message(mod_log, case.log_msg)
+            except NotFound:  # the log entry was deleted, but the case can still be updated
+                log_message = None
+            if log_message is None:
+                pass
+            elif str(case) in log_message.content:
+                # raidmode cases share log messages, so only replace this case's entry
+                await self.bot.edit_message(log_message, log_message.content.replace(str(case), str(updated)))
+            elif len(case_index.by_log.get(case.log_msg, ())) == 1:
+                # e.g. a case from the old bot, logged in a different format
+                await self.bot.edit_message(log_message, str(updated))
+
+        await self.bot.mdb.mod_cases.update_one(
+            {"server": ctx.message.server.id, "num": case.num},
+            {"$set": {"reason": updated.reason, "mod": updated.mod}}
+        )
+        if case.timestamp is not None and case.mod != updated.mod:  # credit the action to its new moderator
+            day = get_stats_day(case.timestamp)
+            await self.update_stats(ctx.message.server.id, {(day, case.type, case.mod): -1,
+                                                            (day, case.type, updated.mod): 1})
+        case.reason = updated.reason
+        case.mod = updated.mod
         await self.bot.say(':ok_hand:')
 
-    async def post_action(self, server, server_settings, case, no_msg=False, no_commit=False, msg=None):
-        """Common function after a moderative action."""
-        server_settings['casenum'] += 1
-        mod_log = discord.utils.get(server.channels, id=MOD_LOG_CHANNEL_ID)
-
-        if mod_log is not None:
-            log_msg = await self.bot.send_message(mod_log, str(case))
-            case.log_msg = log_msg.id
-
-        server_settings['cases'].append(case.to_dict())
-        if not no_commit:
-            await self.set_server_settings(server.id, server_settings)
+    async def post_action(self, server, case, no_msg=False, msg=None):
+        """Common function after a moderative action. Assigns the case its number and records it."""
+        await self.record_cases(server, [case])
         if not no_msg:
             await self.bot.say(msg or ':ok_hand:')
 
-    async def start_lockdown(self, ctx, server_settings):
-        """Disables Send Messages permission for everyone in every channel."""
-        server_settings['locked_channels'] = []
-        everyone_role = ctx.message.server.default_role
-        for channel in ctx.message.server.channels:
-            if not channel.type == discord.ChannelType.text:
-                continue
-            overwrites = channel.overwrites_for(everyone_role)
-            if overwrites.send_messages is not False:  # is not false, since it could be None
-                overwrites.send_messages = False
-                server_settings['locked_channels'].append(channel.id)
-                await self.bot.edit_channel_permissions(channel, everyone_role, overwrite=overwrites)
+    async def record_cases(self, server, cases):
+        """Numbers, logs, and saves a batch of cases, posting as few mod-log messages as possible."""
+        first_num = await self.next_case_num(server.id, len(cases))
+        for i, case in enumerate(cases):
+            case.num = first_num + i
 
-        await self.bot.say(f"Locked down {len(server_settings['locked_channels'])} channels.")
+        mod_log = discord.utils.get(server.channels, id=MOD_LOG_CHANNEL_ID)
+        if mod_log is not None:
+            for group in group_cases(cases):
+                try:
+                    log_msg = await self.bot.send_message(mod_log, '\n\n'.join(str(case) for case in group))
+                except discord.HTTPException as e:  # the cases are still worth saving without a log entry
+                    traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+                    continue
+                for case in group:
+                    case.log_msg = log_msg.id
+
+        # an index being loaded must either see these cases in the database or have them added once it is cached
+        async with self._case_locks[server.id]:
+            await self.bot.mdb.mod_cases.insert_many([dict(case.to_dict(), server=server.id) for case in cases])
+            case_index = self._case_indexes.get(server.id)
+            if case_index is not None:
+                for case in cases:
+                    case_index.add(case)
+        await self.update_stats(server.id, collections.Counter(
+            (get_stats_day(case.timestamp), case.type, case.mod) for case in cases))
+
+    async def update_stats(self, server_id, changes):
+        """Adjusts a server's daily action counters, given as {(day, type, mod): change}."""
+        ops = [UpdateOne({"server": server_id, "day": day, "type": type_, "mod": mod}, {"$inc": {"count": change}},
+                         upsert=True)
+               for (day, type_, mod), change in changes.items() if change]
+        if ops:
+            await self.bot.mdb.mod_stats.bulk_write(ops, ordered=False)
+
+    async def say_paginated(self, text):
+        """Says a possibly long message, split on lines into messages under the 2000 character limit."""
+        for chunk in chunk_text(text.split('\n')):
+            await self.bot.say(chunk)
+
+    async def start_lockdown(self, ctx, server_settings):
+        """Disables Send Messages permission for everyone in every channel.
+        Channels already locked are skipped, so this also resumes an interrupted lockdown."""
+        server = ctx.message.server
+        text_channels = [c for c in server.channels if c.type == discord.ChannelType.text]
+        edits = diff_overwrites(text_channels, server.default_role, send_messages=False)
+        locked = server_settings['locked_channels']
+
+        # channels are recorded before they are locked, so a crash part way through can't leave any locked for good
+        ids = [channel.id for channel, _, _ in edits]
+        if ids:
+            await self.bot.mdb.mod.update_one({"server": server.id},
+                                              {"$addToSet": {"locked_channels": {"$each": ids}}}, upsert=True)
+        locked.extend(i for i in ids if i not in locked)
+
+        failed = await self.bulk_overwrite(edits, "Locking down")
+        if failed:
+            failed_ids = [c.id for c in failed]
+            await self.bot.mdb.mod.update_one({"server": server.id},
+                                              {"$pull": {"locked_channels": {"$in": failed_ids}}})
+            locked[:] = [i for i in locked if i not in failed_ids]
+        await self.bot.say(f"Locked down {len(locked)} channels.")
 
     async def end_lockdown(self, ctx, server_settings):
         """Reenables Send Messages for everyone in locked-down channels."""
-        everyone_role = ctx.message.server.default_role
-        for chan in server_settings['locked_channels']:
-            channel = discord.utils.get(ctx.message.server.channels, id=chan)
-            overwrites = channel.overwrites_for(everyone_role)
-            overwrites.send_messages = None
-            await self.bot.edit_channel_permissions(channel, everyone_role, overwrite=overwrites)
-
-        await self.bot.say(f"Unlocked {len(server_settings['locked_channels'])} channels.")
-        server_settings['locked_channels'] = []
-
-    async def check_raidmode(self, server_settings, member):
-        """Checks whether a newly-joined member should be removed due to raidmode."""
-        try:
-            self.no_ban_logs.add(member.server.id)
-            if not server_settings['raidmode']:
-                return
-            elif server_settings['raidmode'] == 'kick':
-                await self.bot.kick(member)
-                action = 'kick'
-            else:
-                await self.bot.ban(member)
-                action = 'ban'
-        except Forbidden:
-            return
-        finally:
-            self.no_ban_logs.remove(member.server.id)
-        case = Case.new(num=server_settings['casenum'], type_=action, user=member.id, username=str(member),
-                        reason=f"Raidmode auto{action}", mod=str(self.bot.user))
-        await self.post_action(member.server, server_settings, case, no_msg=True)
+        server = ctx.message.server
+        locked = set(server_settings['locked_channels'])
+        channels = [c for c in server.channels if c.id in locked]
+        edits = diff_overwrites(channels, server.default_role, send_messages=None)
+
+        async def on_unlocked(channels):
+            await self.bot.mdb.mod.update_one({"server": server.id},
+                                              {"$pull": {"locked_channels": {"$in": [c.id for c in channels]}}})
+
+        failed = await self.bulk_overwrite(edits, "Unlocking", on_unlocked)
+        await self.bot.say(f"Unlocked {len(locked) - len(failed)} channels.")
+        server_settings['locked_channels'] = [c.id for c in failed]
+
+    async def bulk_overwrite(self, edits, verb, on_applied=None):
+        """Applies permission overwrite edits, reporting progress in the current channel.
+        on_applied(channels) is awaited with each batch of channels edited successfully. Returns the failed channels."""
+        if not edits:
+            return []
+        progress = await self.bot.say(f"{verb} {len(edits)} channels...")
+
+        async def on_progress(channels, done, total):
+            if on_applied is not None:
+                await on_applied(channels)
+            if done < total:
+                await self.bot.edit_message(progress, f"{verb} {len(edits)} channels... ({done}/{total})")
+
+        failed = await bulk_edit_permissions(self.bot, edits, on_progress)
+        if failed:
+            await self.bot.edit_message(progress, f"{verb} {len(edits)} channels... failed in "
+                                                  f"{', '.join(c.name for c in failed)}.")
+        else:
+            await self.bot.edit_message(progress, f"{verb} {len(edits)} channels... done.")
+        return failed
+
+    async def check_raidmode(self, join_state, member):
+        """Checks whether a newly-joined member should be removed due to raidmode.
+        Returns whether they were queued for removal."""
+        autoraid = join_state.autoraid
+        if autoraid is not None and not join_state.raidmode:
+            join_rate = self._join_rates.get(member.server.id)
+            if join_rate is None:
+                join_rate = SlidingWindow(autoraid['window'])
+                self._join_rates.set(member.server.id, join_rate)
+            if join_rate.hit() >= autoraid['threshold']:
+                join_rate.events.clear()  # alert again only after another full burst
+                await self.start_auto_raidmode(member.server, join_state)
+
+        if not join_state.raidmode:
+            return False
+        responder = self._raid_responders.get(member.server.id)
+        if responder is None:
+            responder = self._raid_responders[member.server.id] = RaidResponder(self, member.server)
+        responder.add(member, 'kick' if join_state.raidmode == 'kick' else 'ban')
+        return True
+
+    async def start_auto_raidmode(self, server, join_state):
+        """Responds to a detected raid as the server's autoraid setting says: alerts, or also enables raidmode."""
+        autoraid = join_state.autoraid
+        out = f"**Raid detected**: {autoraid['threshold']} joins in {autoraid['window']} seconds.\n"
+        if autoraid['action'] == 'alert':
+            out += "Use `.raidmode` to enable raid mode."
+        else:
+            join_state.raidmode = autoraid['action']
+            await self.set_server_settings(server.id, {"raidmode": autoraid['action']})
+            out += f"Raid mode enabled. Method: {autoraid['action']}. Use `.raidmode` to disable it."
+        mod_log = discord.utils.get(server.channels, id=MOD_LOG_CHANNEL_ID)
+        if mod_log is not None:
+            await self.bot.send_message(mod_log, out)
 
-    async def check_forceban(self, server_settings, member):
+    async def check_forceban(self, join_state, member):
         """Checks whether a newly-joined member should be removed due to forceban."""
-        if member.id in server_settings['forcebanned']:
+        if member.id in join_state.forcebanned:
             try:
-                self.no_ban_logs.add(member.server.id)
-                await self.bot.ban(member)
+                with self.expected.expecting(member.server.id, member.id, 'ban'):
+                    await self.bot.ban(member)
             except Forbidden:
                 return
-            finally:
-                self.no_ban_logs.remove(member.server.id)
-            case = Case.new(num=server_settings['casenum'], type_='ban', user=member.id, username=str(member),
+            case = Case.new(type_='ban', user=member.id, username=str(member),
                             reason="User forcebanned previously", mod=str(self.bot.user))
-            await self.post_action(member.server, server_settings, case, no_msg=True)
+            await self.post_action(member.server, case, no_msg=True)
 
-    async def check_mutes(self, server_settings, member):
+    async def check_mutes(self, join_state, member):
         """Checks whether a newly-joined member should be muted due to previous mutes."""
-        if member.id in server_settings['muted']:
+        if member.id in join_state.muted:
             try:
-                self.no_ban_logs.add(member.server.id)
                 role = discord.utils.get(member.server.roles, id=MUTED_ROLE)
-                await self.bot.add_roles(member, role)
+                with self.expected.expecting(member.server.id, member.id, 'mute'):
+                    await self.bot.add_roles(member, role)
             except Forbidden:
                 return
-            finally:
-                self.no_ban_logs.remove(member.server.id)
-            case = Case.new(num=server_settings['casenum'], type_='mute', user=member.id, username=str(member),
+            case = Case.new(type_='mute', user=member.id, username=str(member),
                             reason="User attempted to evade mute", mod=str(self.bot.user))
-            await self.post_action(member.server, server_settings, case, no_msg=True)
+            await self.post_action(member.server, case, no_msg=True)
+
+    async def load_privileged_roles(self):
+        """Hands every server's configured mod and admin roles to the permission checks."""
+        async for server_settings in self.bot.mdb.mod.find({"mod_roles": {"$exists": True}},
+                                                           ['server', 'mod_roles', 'admin_roles']):
+            checks.set_privileged_roles(server_settings['server'], server_settings['mod_roles'],
+                                        server_settings['admin_roles'])
+
+    async def set_privileged_roles(self, server_id, mod_roles, admin_roles):
+        checks.set_privileged_roles(server_id, mod_roles, admin_roles)
+        if mod_roles is None and admin_roles is None:
+            await self.bot.mdb.mod.update_one({"server": server_id}, {"$unset": {"mod_roles": "", "admin_roles": ""}})
+        else:
+            await self.set_server_settings(server_id, {"mod_roles": list(mod_roles), "admin_roles": list(admin_roles)})
+
+    async def load_pending_actions(self):
+        """Schedules every pending action saved in the database."""
+        async for action in self.bot.mdb.mod_pending.find():
+            self.pending.schedule(action['time'], action)
+
+    async def add_pending_action(self, action):
+        await self.bot.mdb.mod_pending.insert_one(action)  # sets action['_id']
+        self.pending.schedule(action['time'], action)
 
-    async def check_pending(self):
-        """Checks for pending actions and executes them if the time is right."""
+    async def run_pending_actions(self, actions):
+        """Executes due pending actions concurrently."""
+        print(f"Executing pending actions: {actions}")
+        await asyncio.gather(*(self.run_pending_action(action) for action in actions))
+
+    async def run_pending_action(self, action):
         try:
-            await self.bot.wait_until_ready()
-            while not self.bot.is_closed:
-                now = datetime.datetime.now()
-                async for server in self.bot.mdb.mod.find({"pending_actions.time": {"$lte": now}}):
-                    print(f"Executing pending actions: {server['pending_actions']}")
-                    for action in server['pending_actions']:
-                        if action['time'] > now:
-                            continue
-                        try:
-                            self.no_ban_logs.add(server['server'])
-                            if action['action'] == 'unban':
-                                await self.handle_unban(server, action)
-                            elif action['action'] == 'unmute':
-                                await self.handle_unmute(server, action)
-                        except:
-                            continue
-                        finally:
-                            self.no_ban_logs.remove(server['server'])
-                    server['pending_actions'] = [a for a in server['pending_actions'] if a['time'] > now]
-                    await self.set_server_settings(server['server'], server)
-                await asyncio.sleep(60)  # every minute
-        except asyncio.CancelledError:
-            pass
-
-    async def handle_unban(self, server_settings, action):
-        server = self.bot.get_server(server_settings['server'])
+            if action['action'] == 'unban':
+                await self.handle_unban(action)
+            elif action['action'] == 'unmute':
+                await self.handle_unmute(action)
+        except (Forbidden, NotFound) as e:  # retrying won't help
+            print(f"Failed to {action['action']} {action['user']} in {action['server']}: {e}")
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            # the action stays saved, so it is also retried after a restart
+            self.pending.schedule(datetime.datetime.now() + datetime.timedelta(seconds=PENDING_RETRY_DELAY), action)
+            return
+        await self.bot.mdb.mod_pending.delete_one({"_id": action['_id']})
+
+    async def handle_unban(self, action):
+        server = self.bot.get_server(action['server'])
         if not server:
             return
         user = discord.Object(id=action['user'])
-        await self.bot.unban(server, user)
-        case = Case.new(num=server_settings['casenum'], type_='unban', user=user.id, username=str(user.id),
+        with self.expected.expecting(server.id, user.id, 'unban'):
+            await self.bot.unban(server, user)
+        await self.set_forcebanned(server.id, user.id, False)
+        case = Case.new(type_='unban', user=user.id, username=str(user.id),
                         reason=f"Time expired (case #{action['original_case']})", mod=str(self.bot.user))
-        await self.post_action(server, server_settings, case, no_msg=True, no_commit=True)
+        await self.post_action(server, case, no_msg=True)
 
-    async def handle_unmute(self, server_settings, action):
-        server = self.bot.get_server(server_settings['server'])
+    async def handle_unmute(self, action):
+        server = self.bot.get_server(action['server'])
         if not server:
             return
         target = server.get_member(action['user'])
@@ -459,15 +761,18 @@ class Moderation:
             return
         role = discord.utils.get(server.roles, id=MUTED_ROLE)
         if role in target.roles:
-            await self.bot.remove_roles(target, role)
-            case = Case.new(num=server_settings['casenum'], type_='unmute', user=target.id, username=str(target),
+            with self.expected.expecting(server.id, target.id, 'unmute'):
+                await self.bot.remove_roles(target, role)
+            case = Case.new(type_='unmute', user=target.id, username=str(target),
                             reason=f"Time expired (case #{action['original_case']})", mod=str(self.bot.user))
-            on_unmute(server_settings, target)
-            await self.post_action(server, server_settings, case, no_msg=True, no_commit=True)
+            await self.set_muted(server.id, target.id, False)
+            await self.post_action(server, case, no_msg=True)
 
     async def on_message_delete(self, message):
         if not message.server:
             return  # PMs
+        if self._purged.pop(message.id):
+            return  # logged in the purge transcript
         msg_log = discord.utils.get(message.server.channels, id=MESSAGE_LOG_CHANNEL_ID)
         if not msg_log:
             return
@@ -480,7 +785,7 @@ class Moderation:
         embed.colour = 0xff615b
         embed.set_footer(text="Originally sent")
         embed.timestamp = message.timestamp
-        await self.bot.send_message(msg_log, embed=embed)
+        self.get_log_sink(msg_log).put(embed)
 
     async def on_message_edit(self, before, after):
         if not before.server:
@@ -502,53 +807,60 @@ class Moderation:
         else:
             new = str(after.content)[:1000] + "..."
         embed.add_field(name="New Content", value=new)
-        await self.bot.send_message(msg_log, embed=embed)
+        self.get_log_sink(msg_log).put(embed)
+
+    def get_log_sink(self, channel):
+        sink = self._log_sinks.get(channel.id)
+        if sink is None:
+            sink = self._log_sinks[channel.id] = EmbedSink(self.bot, channel)
+        return sink
 
     async def on_member_join(self, member):
-        server_settings = await self.get_server_settings(member.server.id)
-        await self.check_raidmode(server_settings, member)
-        await self.check_forceban(server_settings, member)
-        await self.check_mutes(server_settings, member)
+        join_state = await self.get_join_state(member.server.id)
+        if await self.check_raidmode(join_state, member):
+            return
+        await self.check_forceban(join_state, member)
+        await self.check_mutes(join_state, member)
 
     async def on_member_ban(self, member):
-        if member.server.id in self.no_ban_logs:
+        if self.expected.consume(member.server.id, member.id, 'ban'):
             return
-        server_settings = await self.get_server_settings(member.server.id)
 
-        case = Case.new(num=server_settings['casenum'], type_='ban', user=member.id, username=str(member),
+        case = Case.new(type_='ban', user=member.id, username=str(member),
                         reason="Unknown reason")
-        await self.post_action(member.server, server_settings, case, no_msg=True)
+        await self.post_action(member.server, case, no_msg=True)
 
     async def on_member_unban(self, server, user):
-        if server.id in self.no_ban_logs:
+        await self.set_forcebanned(server.id, user.id, False)  # unbanning lifts a forceban
+        if self.expected.consume(server.id, user.id, 'unban'):
             return
-        server_settings = await self.get_server_settings(server.id)
 
-        case = Case.new(num=server_settings['casenum'], type_='unban', user=user.id, username=str(user),
+        case = Case.new(type_='unban', user=user.id, username=str(user),
                         reason="Unknown reason")
-        await self.post_action(server, server_settings, case, no_msg=True)
+        await self.post_action(server, case, no_msg=True)
 
     async def on_member_update(self, before, after):
-        if before.server.id in self.no_ban_logs:
-            return
         role = discord.utils.get(before.server.roles, id=MUTED_ROLE)
         if role not in before.roles and role in after.roles:  # just muted
-            server_settings = await self.get_server_settings(before.server.id)
-            case = Case.new(num=server_settings['casenum'], type_='mute', user=after.id, username=str(after),
+            if self.expected.consume(before.server.id, before.id, 'mute'):
+                return
+            case = Case.new(type_='mute', user=after.id, username=str(after),
                             reason="Unknown reason")
-            on_mute(server_settings, before)
+            await self.set_muted(before.server.id, before.id, True)
         elif role in before.roles and role not in after.roles:  # just unmuted
-            server_settings = await self.get_server_settings(before.server.id)
-            case = Case.new(num=server_settings['casenum'], type_='unmute', user=after.id, username=str(after),
+            if self.expected.consume(before.server.id, before.id, 'unmute'):
+                return
+            case = Case.new(type_='unmute', user=after.id, username=str(after),
                             reason="Unknown reason")
-            on_unmute(server_settings, before)
+            await self.set_muted(before.server.id, before.id, False)
         else:
             return
 
-        await self.post_action(before.server, server_settings, case, no_msg=True)
+        await self.post_action(before.server, case, no_msg=True)
 
     async def get_server_settings(self, server_id):
-        server_settings = await self.bot.mdb.mod.find_one({"server": server_id})
+        # exclude any data left over from before it was moved to mod_cases and mod_pending
+        server_settings = await self.bot.mdb.mod.find_one({"server": server_id}, LEGACY_PROJECTION)
         if server_settings is None:
             server_settings = get_default_settings(server_id)
         else:
@@ -564,21 +876,102 @@ class Moderation:
             {"$set": settings}, upsert=True
         )
 
+    async def next_case_num(self, server_id, count=1):
+        """Atomically allocates the next *count* case numbers in a server, returning the first."""
+        while True:
+            server_settings = await self.bot.mdb.mod.find_one_and_update(
+                {"server": server_id, "casenum": {"$exists": True}}, {"$inc": {"casenum": count}},
+                projection={"casenum": True}, return_document=ReturnDocument.BEFORE)
+            if server_settings is not None:
+                return server_settings['casenum']
+
+            # the server has no settings, or settings from before the counter existed; start it at 1, then retry
+            try:
+                await self.bot.mdb.mod.update_one({"server": server_id},
+                                                  {"$setOnInsert": get_default_settings(server_id)}, upsert=True)
+            except DuplicateKeyError:  # another allocation created them first; mod.server is unique
+                pass
+            await self.bot.mdb.mod.update_one({"server": server_id, "casenum": {"$exists": False}},
+                                              {"$set": {"casenum": 1}})
+
+    async def get_join_state(self, server_id):
+        """Returns the raidmode, forceban and mute state of a server, loading it from the database once."""
+        join_state = self._join_states.get(server_id)
+        if join_state is None:
+            server_settings = await self.bot.mdb.mod.find_one({"server": server_id},
+                                                              ['raidmode', 'forcebanned', 'muted', 'autoraid'])
+            join_state = JoinState.from_settings(server_settings or {})
+            self._join_states[server_id] = join_state
+        return join_state
+
+    async def set_muted(self, server_id, user_id, muted):
+        """Records whether a user should be re-muted if they rejoin."""
+        join_state = await self.get_join_state(server_id)
+        if muted:
+            join_state.muted.add(user_id)
+        elif user_id in join_state.muted:
+            join_state.muted.remove(user_id)
+        else:
+            return
+        op = "$addToSet" if muted else "$pull"
+        await self.bot.mdb.mod.update_one({"server": server_id}, {op: {"muted": user_id}}, upsert=True)
+
+    async def set_forcebanned(self, server_id, user_id, banned):
+        """Records whether a user should be banned if they join."""
+        join_state = await self.get_join_state(server_id)
+        if banned:
+            join_state.forcebanned.add(user_id)
+        elif user_id in join_state.forcebanned:
+            join_state.forcebanned.remove(user_id)
+        else:
+            return
+        op = "$addToSet" if banned else "$pull"
+        await self.bot.mdb.mod.update_one({"server": server_id}, {op: {"forcebanned": user_id}}, upsert=True)
+
+    async def get_case_index(self, server_id):
+        """Returns an index of a server's cases, loading them from the database on a cache miss."""
+        case_index = self._case_indexes.get(server_id)
+        if case_index is None:
+            async with self._case_locks[server_id]:
+                case_index = self._case_indexes.get(server_id)
+                if case_index is None:  # not loaded while waiting for the lock
+                    cursor = self.bot.mdb.mod_cases.find({"server": server_id}, CASE_PROJECTION).sort("num")
+                    case_index = CaseIndex([Case.from_dict(raw) async for raw in cursor])
+                    self._case_indexes.set(server_id, case_index)
+        return case_index
+
+    async def get_case(self, server_id, num):
+        return (await self.get_case_index(server_id)).by_num.get(num)
+
+    async def get_user_cases(self, server_id, user_id):
+        return (await self.get_case_index(server_id)).by_user.get(user_id, [])
+
 
 def get_default_settings(server):
     return {
         "server": server,
         "raidmode": None,
-        "cases": [],
         "casenum": 1,
         "forcebanned": [],
         "locked_channels": [],
         "muted": [],
-        "pending_actions": [],
-        "warnings": []
+        "autoraid": None
     }
 
 
+def normalize_role(role):
+    """Turns a role mention into its ID, and a role name into the lowercase form the checks compare."""
+    match = re.fullmatch(r'<@&(\d+)>', role)
+    return match.group(1) if match else role.lower()
+
+
+def format_case_history(cases):
+    """Lists a user's previous cases, warnings first."""
+    warnings = [c for c in cases if c.type == 'warn']
+    actions = [c for c in cases if c.type != 'warn']
+    return ''.join(f"[{case.type}] Case {case.num} - {case.reason}\n" for case in warnings + actions)
+
+
 def parse_duration(dur):
     if not dur:
         raise Exception("No duration string given.")
@@ -607,18 +1000,192 @@ def parse_duration(dur):
     return datetime.timedelta(minutes=minutes, hours=hours, days=days, weeks=weeks)
 
 
-def on_mute(server_settings, member):
-    if member.id not in server_settings['muted']:
-        server_settings['muted'].append(member.id)
+def get_stats_day(timestamp):
+    """Returns the start of the (UTC) day that an action's counters are kept under."""
+    return datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+
+
+def group_cases(cases, limit=2000):
+    """Splits cases into groups whose mod-log entries fit in one message."""
+    groups = []
+    length = limit
+    for case in cases:
+        entry_length = len(str(case)) + 2
+        if length + entry_length > limit:
+            groups.append([])
+            length = 0
+        groups[-1].append(case)
+        length += entry_length
+    return groups
+
+
+class RaidResponder:
+    """Kicks or bans members who join a server in raidmode.
 
+    Members are removed by a small pool of workers that only runs while there are members queued, and their cases
+    are recorded together every few seconds instead of one mod-log message and database write each."""
+
+    def __init__(self, cog, server):
+        self.cog = cog
+        self.bot = cog.bot
+        self.server = server
+        self.queue = collections.deque()
+        self.workers = 0
+        self.cases = []
+
+    def add(self, member, action):
+        self.queue.append((member, action))
+        if self.workers < RAID_WORKERS:
+            self.workers += 1
+            self.bot.loop.create_task(self.work())
+
+    async def work(self):
+        try:
+            while self.queue:
+                member, action = self.queue.popleft()
+                try:
+                    await self.remove(member, action)
+                except Exception as e:
+                    traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+        finally:
+            self.workers -= 1
 
-def on_unmute(server_settings, member):
-    if member.id in server_settings['muted']:
-        server_settings['muted'].remove(member.id)
+    async def remove(self, member, action):
+        try:
+            if action == 'kick':
+                await self.bot.kick(member)
+            else:
+                with self.cog.expected.expecting(self.server.id, member.id, 'ban'):
+                    await self.bot.ban(member)
+        except Forbidden:
+            return
+
+        if not self.cases:
+            self.bot.loop.create_task(self.flush())
+        self.cases.append(Case.new(type_=action, user=member.id, username=str(member),
+                                   reason=f"Raidmode auto{action}", mod=str(self.bot.user)))
+
+    async def flush(self, attempt=0):
+        await asyncio.sleep(RAID_LOG_INTERVAL)
+        cases, self.cases = self.cases, []
+        try:
+            await self.cog.record_cases(self.server, cases)
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            if attempt >= RAID_LOG_RETRIES:
+                print(f"Dropped {len(cases)} raidmode cases in {self.server.id}: {[c.user for c in cases]}")
+                return
+            # put the batch back in front of any cases that came in meanwhile, and try again with them
+            if not self.cases:
+                self.bot.loop.create_task(self.flush(attempt + 1))
+            self.cases = cases + self.cases
+
+
+class ExpectedEvents:
+    """Ban, unban, mute and unmute events that the bot expects to cause, so their listeners can skip logging them.
+
+    Each expectation is for one (server, user, event) and is consumed by the first matching event, or expires."""
+
+    def __init__(self):
+        self._expected = LRUCache(EXPECTED_EVENT_SIZE, ttl=EXPECTED_EVENT_TTL)  # (server, user, event) -> count
+
+    def expect(self, server_id, user_id, event):
+        key = (server_id, user_id, event)
+        self._expected.set(key, self._expected.get(key, 0) + 1)
+
+    def consume(self, server_id, user_id, event):
+        """Removes an expectation, returning whether there was one."""
+        key = (server_id, user_id, event)
+        count = self._expected.get(key, 0)
+        if count > 1:
+            self._expected.set(key, count - 1)
+        elif count == 1:
+            self._expected.pop(key)
+        return count > 0
+
+    @contextlib.contextmanager
+    def expecting(self, server_id, user_id, event):
+        """Expects an event for the duration of an action, withdrawing the expectation if the action fails."""
+        self.expect(server_id, user_id, event)
+        try:
+            yield
+        except:
+            self.consume(server_id, user_id, event)
+            raise
+
+
+class JoinState:
+    """The parts of a server's mod settings that are checked on every member join, kept in memory."""
+
+    def __init__(self, raidmode=None, forcebanned=(), muted=(), autoraid=None):
+        self.raidmode = raidmode
+        self.forcebanned = set(forcebanned)
+        self.muted = set(muted)
+        self.autoraid = autoraid
+
+    @classmethod
+    def from_settings(cls, server_settings):
+        return cls(server_settings.get('raidmode'), server_settings.get('forcebanned', ()),
+                   server_settings.get('muted', ()), server_settings.get('autoraid'))
+
+
+class CaseIndex:
+    """A server's cases, by number, by user, and by mod-log message."""
+
+    def __init__(self, cases=()):
+        self.by_num = {}
+        self.by_user = {}
+        self.by_log = {}
+        for case in cases:
+            self.add(case)
+
+    def add(self, case):
+        self.by_num[case.num] = case
+        self.by_user.setdefault(case.user, []).append(case)
+        if case.log_msg:
+            self.by_log.setdefault(case.log_msg, []).append(case)
+
+
+class CaseExport:
+    """One gzipped file of a case export, compressed a case at a time."""
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.count = 0
+        self.buffer = io.BytesIO()
+        self._gzip = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+        if fmt == 'csv':
+            self._write_csv(EXPORT_FIELDS)
+
+    @property
+    def full(self):
+        return self.buffer.tell() >= EXPORT_PART_SIZE
+
+    def write(self, raw):
+        row = Case.from_dict(raw).to_dict()
+        row['timestamp'] = row['timestamp'].isoformat() if row['timestamp'] else None
+        if self.fmt == 'csv':
+            self._write_csv(row[field] for field in EXPORT_FIELDS)
+        else:
+            self._gzip.write(json.dumps(row).encode() + b'\n')
+        self.count += 1
+
+    def _write_csv(self, values):
+        line = io.StringIO()
+        csv.writer(line).writerow(values)
+        self._gzip.write(line.getvalue().encode())
+
+    def finish(self):
+        """Finishes compressing and returns the file, ready to upload."""
+        self._gzip.close()
+        self.buffer.seek(0)
+        return self.buffer
 
 
 class Case:
-    def __init__(self, num, type_, user, reason, mod=None, log_msg=None, username=None):
+    __slots__ = ('num', 'type', 'user', 'username', 'reason', 'mod', 'log_msg', 'timestamp')
+
+    def __init__(self, num, type_, user, reason, mod=None, log_msg=None, username=None, timestamp=None):
         self.num = num
         self.type = type_
         self.user = user
@@ -626,29 +1193,21 @@ class Case:
         self.reason = reason
         self.mod = mod
         self.log_msg = log_msg
+        self.timestamp = timestamp
 
     @classmethod
-    def new(cls, num, type_, user, reason, mod=None, username=None):
-        return cls(num, type_, user, reason, mod=mod, username=username)
+    def new(cls, type_, user, reason, mod=None, username=None):
+        """Creates a case that will be numbered when it is posted."""
+        return cls(None, type_, user, reason, mod=mod, username=username, timestamp=datetime.datetime.utcnow())
 
     @classmethod
     def from_dict(cls, raw):
-        if 'type' in raw:
-            raw['type_'] = raw.pop('type')
-        else:
-            raw['type_'] = 'unknown'
-        return cls(**raw)
-
-    @classmethod
-    def from_id(cls, server_settings, num):
-        raw = next((c for c in server_settings['cases'] if c['num'] == num), None)
-        if not raw:
-            raise Exception("Case not found.")
-        return cls.from_dict(raw)
+        return cls(raw['num'], raw.get('type', 'unknown'), raw['user'], raw.get('reason'), mod=raw.get('mod'),
+                   log_msg=raw.get('log_msg'), username=raw.get('username'), timestamp=raw.get('timestamp'))
 
     def to_dict(self):
         return {"num": self.num, "type": self.type, "user": self.user, "reason": self.reason, "mod": self.mod,
-                "log_msg": self.log_msg, "username": self.username}
+                "log_msg": self.log_msg, "username": self.username, "timestamp": self.timestamp}
 
     def __str__(self):
         if self.username:
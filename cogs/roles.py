@@ -1,79 +1,261 @@
 import asyncio
-import copy
-import json
+import re
+import sys
+import traceback
 
 import discord
-from discord import Emoji
+from discord import Emoji, NotFound
+from discord.ext import commands
 
-REACTION_MSG_ID = '414216008614805505'
-REACTION_MSG_CHAN = '414215561967304710'
+from utils import checks
+from utils.ratelimit import TokenBucket
+
+LEGACY_REACTION_CHAN = '414215561967304710'  # bound automatically when no messages are bound
+LEGACY_REACTION_MSG = '414216008614805505'
 MUTED_ROLES = ('HFSilenced', 'Silenced')
+ROLE_UPDATE_DELAY = 3  # seconds to collect a member's reaction role changes for
+ROLE_SYNC_RATE = (5, 5)  # role updates per seconds while reconciling, leaving room for live reactions
+REACTORS_PER_PAGE = 100
+_MESSAGE_ID = re.compile(r'"message_id":"(\d+)"')
+_ID = re.compile(r'"id":"(\d+)"')
 
 
 class Roles:
     def __init__(self, bot):
         self.bot = bot
-        if not bot.testing:
-            bot.loop.create_task(self.check_reaction_map())
-        self.reaction_map = {}
+        self.bindings = {}  # message id -> ReactionBinding
+        self._emojis = {}  # emoji id -> Emoji
+        self._roles = {}  # server id -> role name -> Role
+        self._role_changes = {}  # (server id, member id) -> role id -> (Role, whether they should have it)
+        self._loading = None if bot.testing else bot.loop.create_task(self.load_bindings())
+        self._reconciling = None
+        bot.gateway.subscribe('MESSAGE_REACTION_ADD', self.handle_raw_reaction_add, self.is_bound_reaction)
+        bot.gateway.subscribe('MESSAGE_REACTION_REMOVE', self.handle_raw_reaction_remove, self.is_bound_reaction)
+        bot.gateway.subscribe('MESSAGE_UPDATE', self.handle_raw_edit, self.is_bound_edit)
 
-    async def check_reaction_map(self):
-        try:
-            await self.bot.wait_until_ready()
-            while not self.bot.is_closed:
-                msg = await self.bot.get_message(self.bot.get_channel(REACTION_MSG_CHAN), REACTION_MSG_ID)
-                old_reaction_map = copy.copy(self.reaction_map)
-                self.reaction_map = {}
-                for line in msg.content.split('\n')[2:]:
-                    line = line.strip()
-                    reaction = line.split(' ')[0]
-                    role = line.split('**')[1]
-                    self.reaction_map[reaction] = role
-                if not old_reaction_map == self.reaction_map:
-                    print(f"New reaction map: {self.reaction_map}")
-                await asyncio.sleep(60 * 60)  # every hour
-        except asyncio.CancelledError:
-            pass
+    def __unload(self):
+        self.bot.gateway.unsubscribe('MESSAGE_REACTION_ADD', self.handle_raw_reaction_add)
+        self.bot.gateway.unsubscribe('MESSAGE_REACTION_REMOVE', self.handle_raw_reaction_remove)
+        self.bot.gateway.unsubscribe('MESSAGE_UPDATE', self.handle_raw_edit)
+
+    async def load_bindings(self):
+        async for raw in self.bot.mdb.reactionroles.find():
+            binding = ReactionBinding.from_dict(raw)
+            self.bindings[binding.message] = binding
+        if not self.bindings:
+            await self.seed_bindings()
 
-    async def on_socket_raw_receive(self, msg):
-        if isinstance(msg, bytes):
+    async def seed_bindings(self):
+        """Binds the reaction role message that was hard-coded before bindings were stored."""
+        await self.bot.mdb.reactionroles.create_index("message", unique=True)
+        await self.bot.mdb.reactionroles.create_index("server")
+        await self.bot.wait_until_ready()
+        channel = self.bot.get_channel(LEGACY_REACTION_CHAN)
+        if channel is None:
             return
-        msg = json.loads(msg)
-        if msg.get('t') != "MESSAGE_REACTION_ADD":
+        try:
+            message = await self.bot.get_message(channel, LEGACY_REACTION_MSG)
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+            return
+        binding = ReactionBinding(channel.server.id, channel.id, message.id, parse_reaction_roles(message.content))
+        await self.save_binding(binding)
+        print(f"Bound legacy reaction roles: {binding.roles}")
+
+    @commands.group(pass_context=True, no_pm=True)
+    @checks.mod_or_permissions(manage_roles=True)
+    async def rr(self, ctx):
+        """Commands to manage reaction roles."""
+        if ctx.invoked_subcommand is None:
+            await self.bot.say("Incorrect usage. Use .help rr for help.")
+
+    @rr.command(pass_context=True)
+    @checks.mod_or_permissions(manage_roles=True)
+    async def bind(self, ctx, channel: discord.Channel, message_id):
+        """Gives out roles for reactions to a message.
+        From the message's third line on, each line should start with an emoji and have the role name in bold.
+        Reacting gives the role and removing the reaction takes it away. Editing the message updates its roles."""
+        try:
+            message = await self.bot.get_message(channel, message_id)
+        except NotFound:
+            return await self.bot.say("Message not found.")
+        # reactions left from when reacting toggled a role don't say who wants it, so such messages aren't reconciled
+        existing = self.bindings.get(message.id)
+        reconcile = existing.reconcile if existing is not None else message.id != LEGACY_REACTION_MSG
+        binding = ReactionBinding(ctx.message.server.id, channel.id, message.id, parse_reaction_roles(message.content),
+                                  reconcile=reconcile)
+        await self.save_binding(binding)
+        roles = '\n'.join(f"{emoji}: {role}" for emoji, role in binding.roles.items())
+        await self.bot.say(f"Bound {len(binding.roles)} reaction roles:\n{roles}")
+
+    @rr.command(pass_context=True)
+    @checks.mod_or_permissions(manage_roles=True)
+    async def unbind(self, ctx, message_id):
+        """Stops giving out roles for reactions to a message."""
+        binding = self.bindings.get(message_id)
+        if binding is None or binding.server != ctx.message.server.id:
+            return await self.bot.say("That message is not bound.")
+        del self.bindings[message_id]
+        await self.bot.mdb.reactionroles.delete_one({"message": message_id})
+        await self.bot.say(':ok_hand:')
+
+    @rr.command(pass_context=True, name='list')
+    @checks.mod_or_permissions(manage_roles=True)
+    async def rr_list(self, ctx):
+        """Lists the server's reaction role messages."""
+        bindings = [b for b in self.bindings.values() if b.server == ctx.message.server.id]
+        if not bindings:
+            return await self.bot.say("No messages are bound.")
+        await self.bot.say('\n'.join(f"<#{b.channel}> {b.message}: {len(b.roles)} roles"
+                                     f"{'' if b.reconcile else ' (legacy, not reconciled)'}" for b in bindings))
+
+    async def save_binding(self, binding):
+        self.bindings[binding.message] = binding
+        await self.bot.mdb.reactionroles.update_one({"message": binding.message}, {"$set": binding.to_dict()},
+                                                    upsert=True)
+
+    def is_bound_reaction(self, raw):
+        match = _MESSAGE_ID.search(raw)
+        return match is not None and match.group(1) in self.bindings
+
+    def is_bound_edit(self, raw):
+        return any(id_ in self.bindings for id_ in _ID.findall(raw))
+
+    async def handle_raw_edit(self, data):
+        binding = self.bindings.get(data['id'])
+        if binding is None or 'content' not in data:  # e.g. an embed was added
             return
+        roles = parse_reaction_roles(data['content'])
+        if roles != binding.roles:
+            binding.roles = roles
+            print(f"New reaction roles for {binding.message}: {roles}")
+            await self.save_binding(binding)
 
-        data = msg['d']
+    async def handle_raw_reaction_add(self, data):
+        await self.handle_raw_reaction(data, True)
+
+    async def handle_raw_reaction_remove(self, data):
+        await self.handle_raw_reaction(data, False)
+
+    async def handle_raw_reaction(self, data, wanted):
         if not data.get('guild_id'):
             return
 
         server = self.bot.get_server(data['guild_id'])
         msg_id = data['message_id']
         member = server.get_member(data['user_id'])
+        if member is None:
+            return
         emoji = self.get_emoji(**data.pop('emoji'))
-        await self.handle_reaction(msg_id, member, emoji, server)
+        await self.handle_reaction(msg_id, member, emoji, server, wanted)
 
-    async def handle_reaction(self, msg_id, member, emoji, server):
-        member_role_names = [r.name for r in member.roles]
-        if not msg_id == REACTION_MSG_ID:
-            return
-        elif member.id == '187421759484592128':
+    async def handle_reaction(self, msg_id, member, emoji, server, wanted):
+        """Records that a member should or should not have a reaction's role, applying it shortly after."""
+        binding = self.bindings.get(msg_id)
+        if binding is None:
             return
-        elif any(r in member_role_names for r in MUTED_ROLES):
+        elif not can_receive_roles(member):
             return
         else:
-            if str(emoji) in self.reaction_map:
-                role = discord.utils.get(server.roles, name=self.reaction_map[str(emoji)])
-                print(f"Handling role change: {role.name} on {member}")
-                if role in member.roles:
-                    await self.bot.remove_roles(member, role)
-                    out = "I have removed the {} role.".format(role.name)
+            if str(emoji) in binding.roles:
+                role = self.get_role(server, binding.roles[str(emoji)])
+                if role is None:  # the role was renamed or deleted
+                    return
+                key = (server.id, member.id)
+                changes = self._role_changes.get(key)
+                if changes is None:
+                    changes = self._role_changes[key] = {}
+                    self.bot.loop.create_task(self.flush_role_changes(server, member.id))
+                if wanted == (role in member.roles):  # e.g. toggled back, so there is nothing to do
+                    changes.pop(role.id, None)
                 else:
-                    await self.bot.add_roles(member, role)
-                    out = "You have been given the {} role.".format(role.name)
+                    changes[role.id] = (role, wanted)
+
+    async def flush_role_changes(self, server, member_id):
+        """Applies a member's reaction role changes from the last few seconds in one request, and tells them once."""
+        await asyncio.sleep(ROLE_UPDATE_DELAY)
+        changes = self._role_changes.pop((server.id, member_id), {})
+        member = server.get_member(member_id)
+        if member is None:
+            return
+        added = [role for role, wanted in changes.values() if wanted and role not in member.roles]
+        removed = [role for role, wanted in changes.values() if not wanted and role in member.roles]
+        if not (added or removed):
+            return
+
+        print(f"Handling role changes on {member}: +{[r.name for r in added]} -{[r.name for r in removed]}")
+        await self.bot.replace_roles(member, *[r for r in member.roles if r not in removed], *added)
+        out = []
+        if added:
+            out.append(f"You have been given the {format_roles(added)}.")
+        if removed:
+            out.append(f"I have removed the {format_roles(removed)}.")
+        try:
+            await self.bot.send_message(member, ' '.join(out))
+        except:
+            pass
+
+    def start_reconcile(self):
+        if self._reconciling is None:
+            self._reconciling = self.bot.loop.create_task(self.reconcile())
+
+    async def reconcile(self):
+        """Gives roles to members who reacted to a bound message while the bot was not listening."""
+        try:
+            if self._loading is not None:
+                await self._loading
+            bucket = TokenBucket(*ROLE_SYNC_RATE)
+            for binding in list(self.bindings.values()):
                 try:
-                    await self.bot.send_message(member, out)
-                except:
-                    pass
+                    await self.reconcile_binding(binding, bucket)
+                except Exception as e:
+                    traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+        finally:
+            self._reconciling = None
+
+    async def reconcile_binding(self, binding, bucket):
+        server = self.bot.get_server(binding.server)
+        if server is None or not binding.reconcile:
+            return
+        roles = {}  # role id -> (Role, emoji)
+        for emoji, name in binding.roles.items():
+            role = self.get_role(server, name)
+            if role is not None:
+                roles[role.id] = (role, emoji)
+
+        holders = {role_id: set() for role_id in roles}
+        for member in server.members:
+            for role in member.roles:
+                if role.id in holders:
+                    holders[role.id].add(member.id)
+
+        missing = {}  # member id -> [Role]
+        for role_id, (role, emoji) in roles.items():
+            for user_id in await self.get_reactors(binding, emoji) - holders[role_id]:
+                missing.setdefault(user_id, []).append(role)
+
+        given = 0
+        for user_id, roles_to_add in missing.items():
+            member = server.get_member(user_id)
+            if member is None or not can_receive_roles(member) or (server.id, user_id) in self._role_changes:
+                continue  # left, can't have roles, or a live reaction is about to be applied
+            await bucket.wait()
+            await self.bot.add_roles(member, *roles_to_add)
+            given += 1
+        if given:
+            print(f"Reconciled reaction roles for {binding.message}: gave roles to {given} members")
+
+    async def get_reactors(self, binding, emoji):
+        """Returns the IDs of everyone who reacted to a bound message with an emoji."""
+        reactors = set()
+        after = None
+        while True:
+            page = await self.bot.http.get_reaction_users(binding.message, binding.channel, get_api_emoji(emoji),
+                                                          REACTORS_PER_PAGE, after=after)
+            reactors.update(user['id'] for user in page)
+            if len(page) < REACTORS_PER_PAGE:
+                return reactors
+            after = page[-1]['id']
 
     def get_emoji(self, **data):
         id_ = data['id']
@@ -81,11 +263,108 @@ class Roles:
         if not id_:
             return data['name']
 
+        emoji = self._emojis.get(id_)
+        if emoji is None:
+            return Emoji(server=None, **data)
+        return emoji
+
+    def get_role(self, server, name):
+        return self._roles.get(server.id, {}).get(name)
+
+    def index_server(self, server):
+        for emoji in server.emojis:
+            self._emojis[emoji.id] = emoji
+        self.index_roles(server)
+
+    def index_roles(self, server):
+        roles = {}
+        for role in reversed(server.roles):  # the first role with a name wins, like discord.utils.get
+            roles[role.name] = role
+        self._roles[server.id] = roles
+
+    async def on_ready(self):
+        self._emojis = {}
+        self._roles = {}
         for server in self.bot.servers:
-            for emoji in server.emojis:
-                if emoji.id == id_:
-                    return emoji
-        return Emoji(server=None, **data)
+            self.index_server(server)
+        self.start_reconcile()
+
+    async def on_resumed(self):
+        self.start_reconcile()
+
+    async def on_server_join(self, server):
+        self.index_server(server)
+
+    async def on_server_remove(self, server):
+        for emoji in server.emojis:
+            self._emojis.pop(emoji.id, None)
+        self._roles.pop(server.id, None)
+
+    async def on_server_emojis_update(self, before, after):
+        for emoji in before:
+            self._emojis.pop(emoji.id, None)
+        for emoji in after:
+            self._emojis[emoji.id] = emoji
+
+    async def on_server_role_create(self, role):
+        self.index_roles(role.server)
+
+    async def on_server_role_delete(self, role):
+        self.index_roles(role.server)
+
+    async def on_server_role_update(self, before, after):
+        self.index_roles(after.server)
+
+
+def parse_reaction_roles(content):
+    """Reads emoji -> role name from a reaction role message: from the third line on, `emoji ... **Role**`."""
+    roles = {}
+    for line in content.split('\n')[2:]:
+        line = line.strip()
+        if line.count('**') < 2:
+            continue
+        roles[line.split(' ')[0]] = line.split('**')[1]
+    return roles
+
+
+def can_receive_roles(member):
+    if member.bot or member.id == '187421759484592128':
+        return False
+    return not any(r.name in MUTED_ROLES for r in member.roles)
+
+
+def get_api_emoji(emoji):
+    """Converts an emoji as written in a message to the form the reactions API takes: unicode or `name:id`."""
+    match = re.fullmatch(r'<a?:(\w+:\d+)>', emoji)
+    return match.group(1) if match else emoji
+
+
+def format_roles(roles):
+    if len(roles) == 1:
+        return f"{roles[0].name} role"
+    return f"{', '.join(r.name for r in roles[:-1])} and {roles[-1].name} roles"
+
+
+class ReactionBinding:
+    __slots__ = ('server', 'channel', 'message', 'roles', 'reconcile')
+
+    def __init__(self, server, channel, message, roles, reconcile=False):
+        self.server = server
+        self.channel = channel
+        self.message = message
+        self.roles = roles  # emoji -> role name
+        self.reconcile = reconcile  # whether its reactions were all made since a reaction meant wanting the role
+
+    @classmethod
+    def from_dict(cls, raw):
+        return cls(raw['server'], raw['channel'], raw['message'], {r['emoji']: r['role'] for r in raw['roles']},
+                   reconcile=raw.get('reconcile', False))
+
+    def to_dict(self):
+        # emoji can't be used as keys, since they may contain dots
+        return {"server": self.server, "channel": self.channel, "message": self.message,
+                "roles": [{"emoji": emoji, "role": role} for emoji, role in self.roles.items()],
+                "reconcile": self.reconcile}
 
 
 def setup(bot):
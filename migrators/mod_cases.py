@@ -0,0 +1,45 @@
+import asyncio
+
+import motor.motor_asyncio
+from pymongo import UpdateOne
+
+
+async def migrate_cases(mdb):
+    print("Migrating mod cases...")
+    async for server in mdb.mod.find({"cases": {"$exists": True}}):
+        print(f"Migrating {server['server']}...")
+        cases = [dict(case, server=server['server']) for case in server['cases']]
+        if cases:
+            # upserted, so rerunning after a crash before the $unset doesn't copy cases twice; the whole case is the
+            # key rather than its number, since the old bot could give two cases the same number
+            await mdb.mod_cases.bulk_write([UpdateOne(case, {"$setOnInsert": case}, upsert=True) for case in cases],
+                                           ordered=False)
+        # warnings are just the server's warn cases
+        await mdb.mod.update_one({"_id": server['_id']}, {"$unset": {"cases": "", "warnings": ""}})
+        print(f"Migrated {len(cases)} cases.")
+
+    await mdb.mod_cases.create_index([("server", 1), ("num", 1)])
+    await mdb.mod_cases.create_index([("server", 1), ("user", 1)])
+
+
+async def index_settings(mdb):
+    print("Indexing mod settings...")
+    duplicates = await mdb.mod.aggregate([
+        {"$group": {"_id": "$server", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]).to_list(None)
+    if duplicates:
+        # two settings documents for a server would let case numbers be allocated twice
+        print(f"Servers with more than one mod document, merge these first: {[d['_id'] for d in duplicates]}")
+        return
+    await mdb.mod.create_index("server", unique=True)
+
+
+async def run(mdb):
+    await migrate_cases(mdb)
+    await index_settings(mdb)
+
+
+if __name__ == '__main__':
+    mdb = motor.motor_asyncio.AsyncIOMotorClient(input("Mongo: ")).azuth
+    asyncio.get_event_loop().run_until_complete(run(mdb))
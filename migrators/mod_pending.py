@@ -0,0 +1,25 @@
+import asyncio
+
+import motor.motor_asyncio
+
+
+async def migrate_pending(mdb):
+    print("Migrating pending actions...")
+    async for server in mdb.mod.find({"pending_actions": {"$exists": True}}, ['server', 'pending_actions']):
+        print(f"Migrating {server['server']}...")
+        actions = [dict(action, server=server['server']) for action in server['pending_actions']]
+        if actions:
+            await mdb.mod_pending.insert_many(actions)
+        await mdb.mod.update_one({"_id": server['_id']}, {"$unset": {"pending_actions": ""}})
+        print(f"Migrated {len(actions)} pending actions.")
+
+    await mdb.mod_pending.create_index("time")
+
+
+async def run(mdb):
+    await migrate_pending(mdb)
+
+
+if __name__ == '__main__':
+    mdb = motor.motor_asyncio.AsyncIOMotorClient(input("Mongo: ")).azuth
+    asyncio.get_event_loop().run_until_complete(run(mdb))
@@ -0,0 +1,56 @@
+import asyncio
+import collections
+import datetime
+
+import motor.motor_asyncio
+from pymongo import UpdateOne
+
+DISCORD_EPOCH = 1420070400000  # ms
+
+
+def get_case_time(case):
+    """Returns when a case happened: when its mod-log message was sent, or failing that, when it was saved.
+    Cases copied by the mod_cases migrator were saved at migration time, so the log message is preferred."""
+    if case.get('log_msg'):
+        return datetime.datetime.utcfromtimestamp(((int(case['log_msg']) >> 22) + DISCORD_EPOCH) / 1000)
+    return case['_id'].generation_time.replace(tzinfo=None)
+
+
+async def backfill_timestamps(mdb):
+    print("Backfilling case timestamps...")
+    ops = []
+    async for case in mdb.mod_cases.find({"timestamp": {"$exists": False}}, ['_id', 'log_msg']):
+        ops.append(UpdateOne({"_id": case['_id']}, {"$set": {"timestamp": get_case_time(case)}}))
+    if ops:
+        await mdb.mod_cases.bulk_write(ops, ordered=False)
+    print(f"Backfilled {len(ops)} timestamps.")
+
+
+async def backfill_stats(mdb):
+    print("Building mod stats...")
+    counts = collections.Counter()
+    async for case in mdb.mod_cases.find({}, ['server', 'type', 'mod', 'timestamp']):
+        timestamp = case['timestamp']
+        day = datetime.datetime(timestamp.year, timestamp.month, timestamp.day)
+        counts[case['server'], day, case.get('type', 'unknown'), case.get('mod')] += 1
+
+    await mdb.mod_stats.create_index([("server", 1), ("day", 1), ("type", 1), ("mod", 1)], unique=True)
+    # counters are rebuilt from every case and set, so rerunning is safe, but any increments the bot makes while
+    # this runs are overwritten
+    ops = [UpdateOne({"server": server, "day": day, "type": type_, "mod": mod}, {"$set": {"count": count}},
+                     upsert=True)
+           for (server, day, type_, mod), count in counts.items()]
+    if ops:
+        await mdb.mod_stats.bulk_write(ops, ordered=False)
+    print(f"Wrote {len(ops)} counters.")
+
+
+async def run(mdb):
+    await backfill_timestamps(mdb)
+    await backfill_stats(mdb)
+
+
+if __name__ == '__main__':
+    print("Stop the bot before running this, or actions taken meanwhile will be missing from the stats.")
+    mdb = motor.motor_asyncio.AsyncIOMotorClient(input("Mongo: ")).azuth
+    asyncio.get_event_loop().run_until_complete(run(mdb))
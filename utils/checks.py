@@ -1,5 +1,9 @@
+import collections
+
+import discord
 from discord.ext import commands
-import discord.utils
+
+from utils.cache import LRUCache
 
 
 #
@@ -22,52 +26,127 @@ def is_owner():
 # required to execute the command (and the bot does as well) then it goes through
 # and you can execute the command.
 # If these checks fail, then there are two fallbacks.
-# A role with the name of Bot Mod and a role with the name of Bot Admin.
+# Mod roles and admin roles, which default to roles named Moderator and Admin
+# and can be set per server by name or ID (see set_privileged_roles).
 # Having these roles provides you access to certain commands without actually having
 # the permissions required for them.
 # Of course, the owner will always be able to execute commands.
+#
+# What a member can do in a channel is resolved once and cached under their roles,
+# so it only changes when they gain or lose a role, or when invalidate() is called
+# for the server because its roles, channels or owner changed.
 
-def check_permissions(ctx, perms):
-    if is_owner_check(ctx):
-        return True
+DEFAULT_MOD_ROLES = ("moderator",)
+DEFAULT_ADMIN_ROLES = ("admin",)
+PRIVILEGE_CACHE_SIZE = 10000
 
-    ch = ctx.message.channel
-    author = ctx.message.author
-    resolved = ch.permissions_for(author)
-    return all(getattr(resolved, name, None) == value for name, value in perms.items())
+_privileges = LRUCache(PRIVILEGE_CACHE_SIZE)  # (server, member, role ids, channel, generation) -> Privileges
+_role_settings = {}  # server id -> (mod role names/ids, admin role names/ids)
+_role_ids = {}  # server id -> (generation, mod role ids, admin role ids)
+_generations = collections.Counter()  # server id -> generation
 
 
-def role_or_permissions(ctx, check, **perms):
-    if check_permissions(ctx, perms):
-        return True
+class Privileges:
+    __slots__ = ('permissions', 'mod', 'admin')
+
+    def __init__(self, permissions, mod, admin):
+        self.permissions = permissions  # permission bits in the channel
+        self.mod = mod
+        self.admin = admin
+
+
+def invalidate(server_id):
+    """Forgets every resolved privilege in a server."""
+    _generations[server_id] += 1
+
+
+def set_privileged_roles(server_id, mod_roles=None, admin_roles=None):
+    """Sets the role names or IDs that count as mod and admin roles in a server, or resets them to the defaults."""
+    if mod_roles is None and admin_roles is None:
+        _role_settings.pop(server_id, None)
+    else:
+        _role_settings[server_id] = (tuple(mod_roles or ()), tuple(admin_roles or ()))
+    invalidate(server_id)
+
+
+def get_privileged_roles(server_id):
+    return _role_settings.get(server_id, (DEFAULT_MOD_ROLES, DEFAULT_ADMIN_ROLES))
 
+
+def get_privileged_role_ids(server):
+    """Returns the IDs of a server's mod and admin roles, matching names against its roles once per generation."""
+    generation = _generations[server.id]
+    compiled = _role_ids.get(server.id)
+    if compiled is None or compiled[0] != generation:
+        mod_roles, admin_roles = get_privileged_roles(server.id)
+        compiled = (generation, _match_roles(server, mod_roles), _match_roles(server, admin_roles))
+        _role_ids[server.id] = compiled
+    return compiled[1], compiled[2]
+
+
+def _match_roles(server, names_or_ids):
+    keys = {key.lower() for key in names_or_ids}
+    return frozenset(r.id for r in server.roles if r.id in keys or r.name.lower() in keys)
+
+
+def resolve_privileges(ctx):
     ch = ctx.message.channel
     author = ctx.message.author
-    if ch.is_private:
-        return False  # can't have roles in PMs
+    if ch.is_private:  # can't have roles in PMs
+        return Privileges(ch.permissions_for(author).value, False, False)
+
+    role_ids = frozenset(r.id for r in author.roles)
+    key = (ch.server.id, author.id, role_ids, ch.id, _generations[ch.server.id])
+    privileges = _privileges.get(key)
+    if privileges is None:
+        mod_ids, admin_ids = get_privileged_role_ids(ch.server)
+        privileges = Privileges(ch.permissions_for(author).value, not role_ids.isdisjoint(mod_ids | admin_ids),
+                                not role_ids.isdisjoint(admin_ids))
+        _privileges.set(key, privileges)
+    return privileges
+
+
+def compile_permissions(perms):
+    """Turns required permissions like {"ban_members": True} into masks of bits that must be set and unset."""
+    allowed = discord.Permissions.none()
+    denied = discord.Permissions.none()
+    for name, value in perms.items():
+        setattr(allowed if value else denied, name, True)
+    return allowed.value, denied.value
 
-    role = discord.utils.find(check, author.roles)
-    return role is not None
+
+def check_permissions(ctx, perms):
+    if is_owner_check(ctx):
+        return True
+
+    if isinstance(perms, dict):
+        perms = compile_permissions(perms)
+    allowed, denied = perms
+    resolved = resolve_privileges(ctx).permissions
+    return (resolved & allowed) == allowed and not resolved & denied
 
 
 def mod_or_permissions(**perms):
+    perms = compile_permissions(perms)
+
     def predicate(ctx):
-        mod_role = "Moderator".lower()
-        admin_role = "Admin".lower()
-        return role_or_permissions(ctx, lambda r: r.name.lower() in (mod_role, admin_role), **perms)
+        return check_permissions(ctx, perms) or resolve_privileges(ctx).mod
 
     return commands.check(predicate)
 
 
 def admin_or_permissions(**perms):
+    perms = compile_permissions(perms)
+
     def predicate(ctx):
-        admin_role = "Admin".lower()
-        return role_or_permissions(ctx, lambda r: r.name.lower() == admin_role.lower(), **perms)
+        return check_permissions(ctx, perms) or resolve_privileges(ctx).admin
 
     return commands.check(predicate)
 
 
 def serverowner_or_permissions(**perms):
+    perms = compile_permissions(perms)
+
     def predicate(ctx):
         if ctx.message.server is None:
             return False
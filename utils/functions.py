@@ -0,0 +1,15 @@
+def chunk_text(parts, sep='\n', limit=2000):
+    """Joins parts with sep into as few strings of at most limit characters as possible.
+    A single part longer than limit is truncated."""
+    chunks = []
+    current = ''
+    for part in parts:
+        part = part[:limit]
+        if current and len(current) + len(sep) + len(part) > limit:
+            chunks.append(current)
+            current = part
+        else:
+            current = f"{current}{sep}{part}" if current else part
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,49 @@
+import sys
+import traceback
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+
+class GatewayFilter:
+    """Hands raw gateway events to the coroutines subscribed to them, decoding only frames that someone wants.
+
+    Discord writes an event's type as `"t":"TYPE"`, so most frames (presences, typing, messages) are skipped by a
+    substring check instead of a JSON parse. A subscription can also give *raw_check*, a cheap test of the raw frame
+    (like whether a message ID appears in it), to skip frames of its type that it does not care about."""
+
+    def __init__(self):
+        self._subscriptions = {}  # event type -> [(callback, raw_check)]
+
+    def subscribe(self, event, callback, raw_check=None):
+        """Calls `await callback(data)` with the payload of every *event* frame that passes *raw_check*."""
+        self._subscriptions.setdefault(event, []).append((callback, raw_check))
+
+    def unsubscribe(self, event, callback):
+        subscriptions = [s for s in self._subscriptions.get(event, []) if s[0] != callback]
+        if subscriptions:
+            self._subscriptions[event] = subscriptions
+        else:
+            self._subscriptions.pop(event, None)
+
+    async def dispatch(self, msg):
+        if isinstance(msg, bytes):  # zlib-compressed, which the gateway only does for large frames like GUILD_CREATE
+            return
+        wanted = {}  # event type -> [callback]
+        for event, subscriptions in self._subscriptions.items():
+            if f'"t":"{event}"' in msg:
+                callbacks = [callback for callback, raw_check in subscriptions if raw_check is None or raw_check(msg)]
+                if callbacks:
+                    wanted[event] = callbacks
+        if not wanted:
+            return
+
+        msg = _json.loads(msg)
+        # the marker may have been inside the payload (e.g. a message's content) rather than the type
+        for callback in wanted.get(msg.get('t'), []):
+            try:
+                await callback(msg['d'])
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
@@ -0,0 +1,80 @@
+import asyncio
+import collections
+import sys
+import traceback
+
+from discord.http import Route
+
+EMBEDS_PER_MESSAGE = 10
+EMBED_CHARS_PER_MESSAGE = 6000
+
+
+class EmbedSink:
+    """Buffers embeds for a log channel and posts them up to 10 per message.
+
+    Embeds are sent when 10 are waiting or *interval* seconds after the first arrives. While a send is in progress
+    new embeds queue up; once *maxlen* are waiting, further embeds are dropped and counted in the next message."""
+
+    def __init__(self, bot, channel, interval=2, maxlen=500):
+        self.bot = bot
+        self.channel = channel
+        self.interval = interval
+        self.maxlen = maxlen
+        self.queue = collections.deque()
+        self.dropped = 0
+        self._full = asyncio.Event()
+        self._task = None
+
+    def put(self, embed):
+        if len(self.queue) >= self.maxlen:
+            self.dropped += 1
+            return
+        self.queue.append(embed)
+        if len(self.queue) >= EMBEDS_PER_MESSAGE:
+            self._full.set()
+        if self._task is None:
+            self._task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        try:
+            while self.queue:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                while self.queue:
+                    await self.send(self.take_batch())
+                    if len(self.queue) < EMBEDS_PER_MESSAGE:  # so a part-filled queue waits for the interval again
+                        self._full.clear()
+        finally:
+            self._task = None
+
+    def take_batch(self):
+        batch = []
+        length = 0
+        while self.queue and len(batch) < EMBEDS_PER_MESSAGE:
+            embed_length = get_embed_length(self.queue[0])
+            if batch and length + embed_length > EMBED_CHARS_PER_MESSAGE:
+                break
+            batch.append(self.queue.popleft())
+            length += embed_length
+        return batch
+
+    async def send(self, embeds):
+        payload = {"embeds": [e.to_dict() for e in embeds]}
+        if self.dropped:
+            payload['content'] = f"{self.dropped} log entries were dropped due to load."
+            self.dropped = 0
+        try:
+            await self.bot.http.request(Route('POST', '/channels/{channel_id}/messages', channel_id=self.channel.id),
+                                        json=payload)
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+
+
+def get_embed_length(embed):
+    data = embed.to_dict()
+    length = len(data.get('title', '')) + len(data.get('description', ''))
+    length += len(data.get('footer', {}).get('text', ''))
+    length += sum(len(f['name']) + len(f['value']) for f in data.get('fields', []))
+    return length
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+import discord
+
+from utils.ratelimit import TokenBucket
+
+BULK_CONCURRENCY = 5
+BULK_RATE = (10, 1)  # edits per second, well under the global rate limit
+PROGRESS_INTERVAL = 2  # seconds
+
+
+async def bulk_edit_permissions(bot, edits, on_progress=None):
+    """Applies a list of (channel, target, overwrite) permission edits concurrently.
+
+    Each channel's edits go to its own rate limit bucket, so a few run at once, paced to stay under the global limit.
+    If given, on_progress(channels, done, total) is awaited with the channels edited since the last call, at most
+    every few seconds and once at the end. Returns the channels whose edit failed."""
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    bucket = TokenBucket(*BULK_RATE)
+
+    async def apply(channel, target, overwrite):
+        async with semaphore:
+            await bucket.wait()
+            try:
+                await bot.edit_channel_permissions(channel, target, overwrite)
+            except discord.HTTPException:
+                return channel, False
+            return channel, True
+
+    failed = []
+    unreported = []
+    done = 0
+    last_report = time.monotonic()
+    for result in asyncio.as_completed([apply(*edit) for edit in edits]):
+        channel, ok = await result
+        done += 1
+        if not ok:
+            failed.append(channel)
+            continue
+        unreported.append(channel)
+        if on_progress is not None and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+            await on_progress(unreported, done, len(edits))
+            unreported = []
+            last_report = time.monotonic()
+
+    if on_progress is not None:
+        await on_progress(unreported, done, len(edits))
+    return failed
+
+
+def diff_overwrites(channels, target, **changes):
+    """Returns (channel, target, overwrite) edits setting the given permissions for target in each channel,
+    skipping channels where they are already set."""
+    edits = []
+    for channel in channels:
+        overwrite = channel.overwrites_for(target)
+        if all(getattr(overwrite, perm) is value for perm, value in changes.items()):
+            continue
+        overwrite.update(**changes)
+        edits.append((channel, target, overwrite))
+    return edits
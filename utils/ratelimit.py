@@ -0,0 +1,55 @@
+import asyncio
+import collections
+import time
+
+
+class TokenBucket:
+    """Allows up to *rate* actions per *per* seconds, refilling continuously."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate / self.per)
+        self.last = now
+
+    def ready(self):
+        """Returns whether an action is allowed right now, without using a token."""
+        self._refill()
+        return self.tokens >= 1
+
+    def consume(self):
+        """Uses a token and returns True if one is available, otherwise returns False."""
+        if not self.ready():
+            return False
+        self.tokens -= 1
+        return True
+
+    async def wait(self):
+        """Waits until a token is available, then uses it."""
+        while not self.consume():
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class SlidingWindow:
+    """Counts events that happened in the last *window* seconds."""
+
+    def __init__(self, window):
+        self.window = window
+        self.events = collections.deque()
+
+    def hit(self):
+        """Records an event and returns the number of events in the window."""
+        now = time.monotonic()
+        self.events.append(now)
+        return self.count(now)
+
+    def count(self, now=None):
+        now = now if now is not None else time.monotonic()
+        while self.events and self.events[0] <= now - self.window:
+            self.events.popleft()
+        return len(self.events)
@@ -0,0 +1,53 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import sys
+import traceback
+
+
+class Scheduler:
+    """Calls *callback* with a list of items once their deadlines have passed.
+
+    The scheduler sleeps until exactly the next deadline, and is woken early if an earlier one is scheduled.
+    Items due within *grace* seconds of each other are handed to the callback together."""
+
+    def __init__(self, bot, callback, grace=0):
+        self.bot = bot
+        self.callback = callback
+        self.grace = datetime.timedelta(seconds=grace)
+        self._heap = []  # (deadline, tiebreaker, item)
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, deadline, item):
+        heapq.heappush(self._heap, (deadline, next(self._counter), item))
+        if self._heap[0][2] is item:
+            self._wakeup.set()
+
+    async def run(self):
+        try:
+            await self.bot.wait_until_ready()
+            while not self.bot.is_closed:
+                now = datetime.datetime.now()
+                due = []
+                while self._heap and self._heap[0][0] <= now + self.grace:
+                    due.append(heapq.heappop(self._heap)[2])
+                if due:
+                    try:
+                        await self.callback(due)
+                    except Exception as e:
+                        traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+                    continue
+
+                timeout = (self._heap[0][0] - now).total_seconds() if self._heap else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            pass
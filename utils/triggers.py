@@ -0,0 +1,169 @@
+import re
+from collections import deque
+
+TRIGGER_TYPES = ("exact", "prefix", "contains", "regex")
+REGEX_MAX_LENGTH = 200
+REGEX_INPUT_LIMIT = 500  # characters of a message that regex triggers are matched against
+_BACKREF = re.compile(r"\\[1-9]|\(\?P=")
+# a quantified group that itself contains a quantifier, like (a+)+, which can backtrack exponentially
+_NESTED_QUANTIFIER = re.compile(r"\((?:[^()\\]|\\.)*[+*}](?:[^()\\]|\\.)*\)(?:[+*]|\{\d*,)")
+
+
+class AhoCorasick:
+    """Finds every occurrence of a set of literal patterns in one pass over the text."""
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = nxt
+            self._out[state].append(i)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text):
+        """Yields (start, pattern index) for every occurrence of every pattern in text."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for i in out[state]:
+                yield pos - len(self.patterns[i]) + 1, i
+
+
+class TriggerMatcher:
+    """All of a server's custom command triggers, compiled so a message is scanned once.
+
+    Exact triggers are a dict lookup, prefix and word-contains triggers share one Aho-Corasick automaton,
+    and regex triggers are combined into a single alternation where possible."""
+
+    def __init__(self, cmds):
+        self.exact = {}
+        literals = {}  # name -> [command]
+        regexes = []
+        for cmd in cmds:
+            if not cmd['responses']:
+                continue
+            type_ = cmd.get('type', 'exact')
+            if type_ == 'exact':
+                self.exact[cmd['name']] = cmd
+            elif type_ in ('prefix', 'contains'):
+                literals.setdefault(cmd['name'], []).append(cmd)
+            elif type_ == 'regex':
+                if validate_regex(cmd['name']) is not None:  # e.g. saved before patterns were checked
+                    continue
+                regexes.append((re.compile(cmd['name'], re.IGNORECASE), cmd))
+
+        self._literals = list(literals.items())
+        self._automaton = AhoCorasick(name for name, _ in self._literals) if self._literals else None
+
+        self._regex_commands = [cmd for _, cmd in regexes]
+        self._combined = None
+        self._separate = []
+        self._combinable = []
+        for i, (pattern, _) in enumerate(regexes):
+            if _BACKREF.search(pattern.pattern):  # group numbering would change inside the alternation
+                self._separate.append((pattern, i))
+            else:
+                self._combinable.append((pattern, i))
+        if self._combinable:
+            try:
+                self._combined = re.compile('|'.join(f"(?P<_cc{i}>{p.pattern})" for p, i in self._combinable),
+                                            re.IGNORECASE)
+            except re.error:  # e.g. two patterns define the same group name
+                self._separate.extend(self._combinable)
+                self._combinable = []
+
+    def __bool__(self):
+        return bool(self.exact or self._literals or self._regex_commands)
+
+    def match(self, content):
+        """Returns the command whose trigger best matches a message, or None.
+        Exact matches win, then the longest prefix, then the longest word match, then the first regex added."""
+        content = content.strip()
+        lowered = content.lower()
+        if lowered in self.exact:
+            return self.exact[lowered]
+
+        if self._automaton is not None:
+            best_prefix = best_contains = None
+            for start, i in self._automaton.iter_matches(lowered):
+                name, cmds = self._literals[i]
+                end = start + len(name)
+                for cmd in cmds:
+                    if cmd['type'] == 'prefix' and start == 0:
+                        if best_prefix is None or len(name) > best_prefix[0]:
+                            best_prefix = (len(name), cmd)
+                    elif cmd['type'] == 'contains' and _is_word_boundary(lowered, start, end):
+                        if best_contains is None or len(name) > best_contains[0]:
+                            best_contains = (len(name), cmd)
+            if best_prefix or best_contains:
+                return (best_prefix or best_contains)[1]
+
+        content = content[:REGEX_INPUT_LIMIT]
+        candidates = []
+        if self._combined is not None:
+            match = self._combined.search(content)
+            if match:
+                first = min(int(k[3:]) for k, v in match.groupdict().items()
+                            if k.startswith('_cc') and v is not None)
+                # the alternation finds the leftmost match, which may not be the first regex that matches anywhere
+                first = next((i for pattern, i in self._combinable if i < first and pattern.search(content)), first)
+                candidates.append(first)
+        for pattern, i in self._separate:
+            if pattern.search(content):
+                candidates.append(i)
+        if candidates:
+            return self._regex_commands[min(candidates)]
+        return None
+
+
+def validate_regex(pattern):
+    """Returns why a regex can't be used as a trigger, or None if it can."""
+    if len(pattern) > REGEX_MAX_LENGTH:
+        return f"Regex triggers can be at most {REGEX_MAX_LENGTH} characters."
+    if _NESTED_QUANTIFIER.search(pattern):
+        return "Regex triggers can't repeat a group that contains a repeat, like `(a+)+`."
+    try:
+        re.compile(pattern)
+    except re.error as e:
+        return f"Invalid regex: {e}"
+    return None
+
+
+def normalize_trigger(name, type_='exact'):
+    if type_ == 'regex':
+        return name.strip()
+    return name.lower().strip()
+
+
+def _is_word_boundary(text, start, end):
+    return (start == 0 or not _is_word_char(text[start - 1])) and \
+           (end == len(text) or not _is_word_char(text[end]))
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'